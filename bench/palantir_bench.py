@@ -0,0 +1,443 @@
+"""
+End-to-end benchmarks for palantir
+
+Runs ``run_check``, ``prune``, ``resolve_alerts`` and the read views against a
+SQLite database, with salt replaced by an in-process fake fleet of minions.
+Requires the same packages as steward_palantir itself.
+
+Examples::
+
+    python bench/palantir_bench.py --minions 2000 --rounds 10
+    python bench/palantir_bench.py --save baseline.json
+    python bench/palantir_bench.py --compare baseline.json --tolerance 0.2
+
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from pyramid.testing import DummyRequest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from steward_palantir import CheckLoader, load_handlers, compile_checks
+from steward_palantir import tasks, views
+from steward_palantir.cache import DisabledCache
+from steward_palantir.check import Check
+from steward_palantir.models import Base, Alert
+
+
+class FakeFleet(object):
+
+    """
+    In-process stand-in for salt
+
+    Parameters
+    ----------
+    size : int
+        Number of minions
+    latency : float
+        Median response time of a minion in seconds
+    latency_sigma : float
+        Sigma of the log-normal distribution of response times
+    failure_ratio : float
+        Fraction of responses with a non-zero retcode
+    timeout_ratio : float
+        Fraction of minions that don't respond
+    output_size : int
+        Number of characters of stdout in each response
+    seed : int
+
+    """
+    def __init__(self, size, latency=0.005, latency_sigma=0.5,
+                 failure_ratio=0.05, timeout_ratio=0.01, output_size=200,
+                 seed=0):
+        self.rand = random.Random(seed)
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.failure_ratio = failure_ratio
+        self.timeout_ratio = timeout_ratio
+        self.output_size = output_size
+        self.next_id = 0
+        self.minions = []
+        self.add(size)
+
+    def add(self, count):
+        """ Add new minions to the fleet """
+        for _ in xrange(count):
+            self.minions.append('minion%06d.bench' % self.next_id)
+            self.next_id += 1
+
+    def churn(self, ratio):
+        """ Replace a fraction of the minions with new ones """
+        count = int(len(self.minions) * ratio)
+        self.rand.shuffle(self.minions)
+        del self.minions[:count]
+        self.add(count)
+
+    def _response(self):
+        """ Generate a fake 'cmd.run_all' response """
+        retcode = 0
+        if self.rand.random() < self.failure_ratio:
+            retcode = self.rand.choice((1, 2))
+        return {
+            'pid': self.rand.randint(1, 65535),
+            'retcode': retcode,
+            'stdout': 'x' * self.output_size if retcode == 0 else
+                      ('%d' % self.rand.randint(0, 9)) * self.output_size,
+            'stderr': '' if retcode == 0 else 'failed',
+        }
+
+    def _responses(self, target, timeout):
+        """ List of (latency, minion, response) for the minions that respond """
+        responses = []
+        for minion in target.split(','):
+            if self.rand.random() < self.timeout_ratio:
+                continue
+            latency = self.rand.lognormvariate(0, self.latency_sigma) * \
+                self.latency
+            if timeout is not None and latency > timeout:
+                continue
+            responses.append((latency, minion, self._response()))
+        responses.sort()
+        return responses
+
+    def salt_match(self, target, expr_form):
+        """ Replacement for steward_salt.tasks.salt_match """
+        return list(self.minions)
+
+    def salt_key(self, cmd):
+        """ Replacement for steward_salt.tasks.salt_key """
+        return {'minions': list(self.minions)}
+
+    def salt(self, target, fun, kwarg=None, expr_form=None, timeout=None):
+        """ Replacement for steward_salt.tasks.salt """
+        responses = self._responses(target, timeout)
+        # The minions run in parallel, so we wait for the slowest one
+        if responses:
+            time.sleep(responses[-1][0])
+        return dict((minion, response) for _, minion, response in responses)
+
+    def iter_salt(self, target, check):
+        """ Replacement for steward_palantir.tasks._iter_salt """
+        waited = 0
+        for latency, minion, response in self._responses(target,
+                                                          check.timeout):
+            time.sleep(latency - waited)
+            waited = latency
+            yield minion, response
+
+
+class Transaction(object):
+    """ Replacement for the transaction package that commits the session """
+    def __init__(self, db):
+        self.db = db
+
+    def commit(self):
+        """ Commit the session """
+        self.db.commit()
+
+
+class Lock(object):
+    """ Replacement for steward_tasks.lock """
+    @contextmanager
+    def inline(self, *args, **kwargs):
+        """ No-op lock """
+        yield
+
+
+class Config(object):
+    """ Stand-in for the config of a StewardTask """
+    def __init__(self, settings, registry):
+        self.settings = settings
+        self.registry = registry
+
+
+class Registry(object):
+    """ Stand-in for the pyramid registry """
+    pass
+
+
+def create_db(url):
+    """ Create the database and an engine that counts queries """
+    engine = create_engine(url)
+
+    # Let pysqlite use SAVEPOINTs
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, _):
+        """ Disable pysqlite's transaction handling """
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def on_begin(conn):
+        """ Start transactions ourselves """
+        conn.execute('BEGIN')
+
+    queries = [0]
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def on_execute(*_):
+        """ Count the queries """
+        queries[0] += 1
+
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)(), queries
+
+
+def make_checks(count, handlers):
+    """ Create the checks to run """
+    checks = {}
+    for i in xrange(count):
+        check = Check('bench%d' % i, {'cmd': 'true'}, {'minutes': 1},
+                      target='*',
+                      handlers=({'absorb': {'count': 2}},),
+                      raised=({'log': None},),
+                      resolved=({'log': None},))
+        checks[check.name] = check
+    compile_checks(checks, handlers)
+    return checks
+
+
+@contextmanager
+def patched(fleet, db, config):
+    """ Point the palantir tasks at the fake fleet and the database """
+    module_attrs = {
+        'salt_match': fleet.salt_match,
+        'salt_key': fleet.salt_key,
+        'salt': fleet.salt,
+        '_iter_salt': fleet.iter_salt,
+        'lock': Lock(),
+        'transaction': Transaction(db),
+        'pub': lambda *args, **kwargs: None,
+    }
+    saved = dict((name, getattr(tasks, name)) for name in module_attrs)
+    task_classes = []
+    for task in (tasks.run_check, tasks.prune, tasks.resolve_alerts):
+        # Celery may hand out a lazy proxy for the task
+        task = getattr(task, '_get_current_object', lambda t=task: t)()
+        task_classes.append(type(task))
+    try:
+        for name, value in module_attrs.iteritems():
+            setattr(tasks, name, value)
+        for cls in task_classes:
+            cls.db = db
+            cls.config = config
+        yield
+    finally:
+        for name, value in saved.iteritems():
+            setattr(tasks, name, value)
+        for cls in task_classes:
+            del cls.db
+            del cls.config
+
+
+class Recorder(object):
+    """ Records the time and query count of each operation """
+    def __init__(self, db, queries):
+        self.db = db
+        self.queries = queries
+        self.timings = defaultdict(list)
+        self.query_counts = defaultdict(list)
+
+    @contextmanager
+    def measure(self, name):
+        """ Time an operation and commit the session after it """
+        queries = self.queries[0]
+        start = time.time()
+        yield
+        self.db.commit()
+        self.timings[name].append(time.time() - start)
+        self.query_counts[name].append(self.queries[0] - queries)
+
+    def report(self):
+        """ Summarize the measurements """
+        data = {}
+        for name, timings in self.timings.iteritems():
+            ordered = sorted(timings)
+            data[name] = {
+                'runs': len(timings),
+                'runs_per_sec': len(timings) / sum(timings) if sum(timings)
+                else float('inf'),
+                'p50_ms': 1000 * percentile(ordered, 50),
+                'p99_ms': 1000 * percentile(ordered, 99),
+                'queries': sum(self.query_counts[name]) /
+                float(len(timings)),
+            }
+        return data
+
+
+def percentile(ordered, pct):
+    """ Nearest-rank percentile of a sorted list """
+    index = int(round(pct / 100.0 * len(ordered) + 0.5)) - 1
+    return ordered[max(0, min(index, len(ordered) - 1))]
+
+
+def request(db, registry, **params):
+    """ Create a request for calling a view """
+    req = DummyRequest(params=dict((key, str(value)) for key, value in
+                                   params.iteritems()))
+    req.db = db
+    req.registry = registry
+    return req
+
+
+def run(args):
+    """ Run the benchmarks and return the report """
+    settings = {
+        'palantir.stream_results': str(args.stream).lower(),
+        'palantir.history.max_entries': str(args.history),
+        'palantir.reload_interval': '0',
+    }
+    if args.output_limit is not None:
+        settings['palantir.output_limit'] = str(args.output_limit)
+
+    fleet = FakeFleet(args.minions, args.latency / 1000.0, args.latency_sigma,
+                      args.failure_ratio, args.timeout_ratio,
+                      args.output_size, args.seed)
+
+    registry = Registry()
+    registry.settings = settings
+    registry.palantir_handlers = load_handlers({'palantir.handlers': ''})
+    registry.palantir_checks = make_checks(args.checks,
+                                           registry.palantir_handlers)
+    registry.palantir_check_loader = CheckLoader(settings)
+    registry.palantir_disabled = DisabledCache()
+    config = Config(settings, registry)
+
+    db, queries = create_db(args.db)
+    recorder = Recorder(db, queries)
+    with patched(fleet, db, config):
+        for _ in xrange(args.rounds):
+            for name in sorted(registry.palantir_checks):
+                with recorder.measure('run_check'):
+                    tasks.run_check.run(name)
+
+            alerts = [{'check': alert.check, 'minion': alert.minion} for
+                      alert in db.query(Alert).limit(args.resolve)]
+            if alerts:
+                with recorder.measure('resolve_alerts'):
+                    tasks.resolve_alerts.run(alerts, 'bench')
+
+            check = sorted(registry.palantir_checks)[0]
+            minion = fleet.minions[0]
+            with recorder.measure('view:list_alerts'):
+                views.list_alerts(request(db, registry, limit=200))
+            with recorder.measure('view:list_minion_checks'):
+                views.list_minion_checks(request(db, registry,
+                                                 fields='retcode,alert'))
+            with recorder.measure('view:get_check'):
+                views.get_check(request(db, registry, check=check))
+            with recorder.measure('view:get_minion'):
+                views.get_minion(request(db, registry, minion=minion))
+
+            fleet.churn(args.churn)
+            with recorder.measure('prune'):
+                tasks.prune.run()
+
+    report = recorder.report()
+    # ru_maxrss is in kilobytes on Linux
+    report['peak_memory_mb'] = \
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return report
+
+
+def print_report(report):
+    """ Print the report as a table """
+    print '%-26s %6s %10s %10s %10s %9s' % ('operation', 'runs', 'runs/sec',
+                                            'p50 ms', 'p99 ms', 'queries')
+    for name in sorted(report):
+        if name == 'peak_memory_mb':
+            continue
+        stats = report[name]
+        print '%-26s %6d %10.2f %10.2f %10.2f %9.1f' % (
+            name, stats['runs'], stats['runs_per_sec'], stats['p50_ms'],
+            stats['p99_ms'], stats['queries'])
+    print 'peak memory: %.1f MB' % report['peak_memory_mb']
+
+
+def compare(report, baseline, tolerance):
+    """
+    Compare a report against a baseline
+
+    Returns
+    -------
+    regressions : list
+        Descriptions of the operations that got slower or ran more queries
+        than the tolerance allows
+
+    """
+    regressions = []
+    for name, stats in baseline.iteritems():
+        if name not in report or not isinstance(stats, dict):
+            continue
+        for key in ('p50_ms', 'p99_ms', 'queries'):
+            if report[name][key] > stats[key] * (1 + tolerance):
+                regressions.append('%s %s: %.2f -> %.2f' % (
+                    name, key, stats[key], report[name][key]))
+    return regressions
+
+
+def main(argv=None):
+    """ Entry point """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--minions', type=int, default=500)
+    parser.add_argument('--checks', type=int, default=5)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=5,
+                        help="Median minion response time in ms")
+    parser.add_argument('--latency-sigma', type=float, default=0.5)
+    parser.add_argument('--failure-ratio', type=float, default=0.05)
+    parser.add_argument('--timeout-ratio', type=float, default=0.01)
+    parser.add_argument('--output-size', type=int, default=200)
+    parser.add_argument('--output-limit', type=int)
+    parser.add_argument('--churn', type=float, default=0.01,
+                        help="Fraction of minions replaced between rounds")
+    parser.add_argument('--resolve', type=int, default=50,
+                        help="Number of alerts to resolve each round")
+    parser.add_argument('--history', type=int, default=0,
+                        help="palantir.history.max_entries")
+    parser.add_argument('--stream', action='store_true',
+                        help="Set palantir.stream_results")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--db', help="Database url (default a temp file)")
+    parser.add_argument('--save', help="Write the report to this file")
+    parser.add_argument('--compare', help="Compare against a saved report")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    tmpfile = None
+    if args.db is None:
+        handle, tmpfile = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        args.db = 'sqlite:///' + tmpfile
+    try:
+        report = run(args)
+    finally:
+        if tmpfile is not None:
+            os.remove(tmpfile)
+
+    print_report(report)
+    if args.save:
+        with open(args.save, 'w') as outfile:
+            json.dump(report, outfile, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare, 'r') as infile:
+            regressions = compare(report, json.load(infile), args.tolerance)
+        for regression in regressions:
+            print 'REGRESSION: %s' % regression
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,6 +14,7 @@ REQUIREMENTS = [
     'steward_sqlalchemy',
     'steward_tasks',
     'PyYAML',
+    'transaction',
 ]
 
 DATA = {
@@ -4,6 +4,8 @@ from __future__ import unicode_literals
 import imp
 import os
 import sys
+import threading
+import time
 from datetime import timedelta
 
 import inspect
@@ -12,8 +14,11 @@ import yaml
 from pyramid.path import DottedNameResolver
 from pyramid.settings import aslist
 
+from .alerting import coalesce_window
+from .cache import DisabledCache
 from .check import Check
 from .handlers import BaseHandler
+from .scheduler import tick_seconds
 
 
 LOG = logging.getLogger(__name__)
@@ -21,6 +26,9 @@ LOG = logging.getLogger(__name__)
 CHECK_MODULE = 'steward_palantir.plugin_checks'
 HANDLER_MODULE = 'steward_palantir.plugin_handlers'
 
+# Use the libyaml parser if it's available
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 sys.modules[CHECK_MODULE] = imp.new_module(CHECK_MODULE)
 sys.modules[HANDLER_MODULE] = imp.new_module(HANDLER_MODULE)
 
@@ -39,13 +47,10 @@ def iterate_files(filedir, loaders):
 
 def load_yaml_checks(filepath):
     """ Load checks from yaml files """
-    try:
-        with open(filepath, 'r') as infile:
-            file_data = yaml.safe_load(infile)
-            for name, data in file_data.iteritems():
-                yield Check(name, **data)
-    except (yaml.scanner.ScannerError, yaml.parser.ParserError):
-        LOG.exception("Could not load '%s'", filepath)
+    with open(filepath, 'r') as infile:
+        file_data = yaml.load(infile, Loader=YAML_LOADER)
+    for name, data in (file_data or {}).iteritems():
+        yield Check(name, **data)
 
 
 def load_python_checks(filepath):
@@ -78,12 +83,141 @@ DEFAULT_LOADERS = {
 }
 
 
+class CheckLoader(object):
+
+    """
+    Loads the checks from the checks directory and caches them by file
+
+    A file is only parsed again when its modification time or size changes.
+
+    Parameters
+    ----------
+    settings : dict
+        The app settings. Uses ``palantir.checks_dir``,
+        ``palantir.required_meta``, and ``palantir.reload_interval``.
+
+    """
+    def __init__(self, settings):
+        self.checks_dir = settings.get('palantir.checks_dir',
+                                       '/etc/steward/checks')
+        self.required_meta = set(aslist(settings.get('palantir.required_meta',
+                                                     [])))
+        self.reload_interval = float(settings.get('palantir.reload_interval',
+                                                  0))
+        self._files = {}
+        self._last_scan = 0
+        self._lock = threading.Lock()
+
+    def scan(self):
+        """
+        Parse any new or modified check files
+
+        If a file can't be parsed, the error is logged and the checks from
+        its last successful parse are kept. It will be parsed again on the
+        next scan.
+
+        Returns
+        -------
+        changed : bool
+            True if any files were added, modified, or removed
+
+        """
+        LOG.debug("Scanning palantir checks in '%s'", self.checks_dir)
+        changed = False
+        files = dict(self._files)
+        seen = set()
+        for filename in os.listdir(self.checks_dir):
+            _, ext = os.path.splitext(filename)
+            if ext not in DEFAULT_LOADERS:
+                continue
+            absfile = os.path.abspath(os.path.join(self.checks_dir, filename))
+            stat = os.stat(absfile)
+            key = (stat.st_mtime, stat.st_size)
+            seen.add(absfile)
+            cached = files.get(absfile)
+            if cached is not None and cached[0] == key:
+                continue
+            try:
+                checks = list(DEFAULT_LOADERS[ext](absfile))
+            except Exception:
+                LOG.exception("Could not load '%s'", absfile)
+                continue
+            files[absfile] = (key, checks)
+            changed = True
+        for absfile in set(files) - seen:
+            del files[absfile]
+            changed = True
+        self._files = files
+        self._last_scan = time.time()
+        return changed
+
+    def checks(self):
+        """ Get a map of check names to checks from the parsed files """
+        checks = {}
+        for absfile in sorted(self._files):
+            for check in self._files[absfile][1]:
+                if check.name in checks:
+                    LOG.error("Duplicate Palantir check '%s'", check.name)
+                    continue
+                missing_meta = self.required_meta - set(check.meta.keys())
+                if missing_meta:
+                    LOG.error("Check '%s' is missing meta field(s) '%s'",
+                              check.name, ', '.join(missing_meta))
+                    continue
+                checks[check.name] = check
+        return checks
+
+    def reload(self, registry):
+        """
+        Replace ``registry.palantir_checks`` if any checks have changed
+
+        This does nothing unless ``palantir.reload_interval`` seconds have
+        passed since the last scan. If a changed check has invalid handlers,
+        the error is logged and the previous version of the check is kept.
+
+        The new checks are built in a separate dict that replaces the old one,
+        so anything iterating over the old dict is not affected.
+
+        Returns
+        -------
+        reloaded : bool
+
+        """
+        if self.reload_interval <= 0 or \
+                time.time() - self._last_scan < self.reload_interval:
+            return False
+        with self._lock:
+            if time.time() - self._last_scan < self.reload_interval:
+                return False
+            try:
+                if not self.scan():
+                    return False
+            except Exception:
+                LOG.exception("Error reloading palantir checks")
+                return False
+            current = registry.palantir_checks
+            checks = self.checks()
+            for name, check in checks.items():
+                try:
+                    check.compile_handlers(registry.palantir_handlers)
+                except ValueError:
+                    LOG.exception("Could not load check '%s'", name)
+                    if name in current:
+                        checks[name] = current[name]
+                    else:
+                        del checks[name]
+            registry.palantir_checks = checks
+        LOG.info("Reloaded palantir checks")
+        return True
+
+
 def include_client(client):
     """ Add methods to the client """
     client.set_cmd('palantir.alerts', 'steward_palantir.client.do_alerts')
     client.set_cmd('palantir.checks', 'steward_palantir.client.do_checks')
     client.set_cmd('palantir.status', 'steward_palantir.client.do_status')
     client.set_cmd('palantir.minions', 'steward_palantir.client.do_minions')
+    client.set_cmd('palantir.history', 'steward_palantir.client.do_history')
     client.set_cmd('palantir.run_check',
                    'steward_palantir.client.do_run_check')
     client.set_cmd('palantir.resolve', 'steward_palantir.client.do_resolve')
@@ -113,6 +247,7 @@ def include_client(client):
         client.set_autocomplete('palantir.disable_minion_check', minions +
                                 checks)
         client.set_autocomplete('palantir.status', minions + checks)
+        client.set_autocomplete('palantir.history', minions + checks)
         client.set_autocomplete('palantir.resolve', minions + checks)
     except Exception:
         # autocomplete isn't mandatory
@@ -129,20 +264,30 @@ def prune(tasklist):
 
 def load_checks(settings):
     """ Load all palantir checks """
-    checks = {}
-    checks_dir = settings.get('palantir.checks_dir', '/etc/steward/checks')
-    required_meta = set(aslist(settings.get('palantir.required_meta', [])))
-    for check in iterate_files(checks_dir, DEFAULT_LOADERS):
-        if check.name in checks:
-            LOG.error("Duplicate Palantir check '%s'", check.name)
-            continue
-        missing_meta = required_meta - set(check.meta.keys())
-        if missing_meta:
-            LOG.error("Check '%s' is missing meta field(s) '%s'", check.name,
-                      ', '.join(missing_meta))
-            continue
-        checks[check.name] = check
-    return checks
+    loader = CheckLoader(settings)
+    loader.scan()
+    return loader.checks()
+
+
+def compile_checks(checks, handlers):
+    """
+    Compile the handler chains of all checks
+
+    Parameters
+    ----------
+    checks : dict
+        Map of check names to :class:`~steward_palantir.check.Check`s
+    handlers : dict
+        Map of handler names to handler classes
+
+    Raises
+    ------
+    exc : :exc:`ValueError`
+        If any check references a handler that doesn't exist
+
+    """
+    for check in checks.itervalues():
+        check.compile_handlers(handlers)
 
 
 def load_handlers(settings):
@@ -182,24 +327,33 @@ def load_handlers(settings):
 
 def include_tasks(config):
     """ Add tasks """
-    checks_dir = config.settings.get('palantir.checks_dir',
-                                     '/etc/steward/checks')
-    for check in iterate_files(checks_dir, DEFAULT_LOADERS):
-        config.add_scheduled_task(check.name, {
-            'schedule': timedelta(**check.schedule),
-            'task': 'steward_palantir.tasks.run_check',
-            'args': [check.name],
+    config.add_scheduled_task('palantir_tick', {
+        'schedule': timedelta(seconds=tick_seconds(config.settings)),
+        'task': 'steward_palantir.tasks.tick',
+    })
+
+    window = coalesce_window(config.settings)
+    if window > 0:
+        config.add_scheduled_task('palantir_flush_alerts', {
+            'schedule': timedelta(seconds=window),
+            'task': 'steward_palantir.tasks.flush_alerts',
         })
 
     config.add_scheduled_task('palantir_prune', {
         'schedule': timedelta(minutes=10),
         'task': 'steward_palantir.tasks.prune',
     })
-    config.registry.palantir_checks = load_checks(config.settings)
+    config.registry.palantir_check_loader = CheckLoader(config.settings)
+    config.registry.palantir_check_loader.scan()
+    config.registry.palantir_checks = \
+        config.registry.palantir_check_loader.checks()
+    config.registry.palantir_disabled = DisabledCache()
 
     def post_setup_load_handlers():
         """ Load handlers as a callback """
         config.registry.palantir_handlers = load_handlers(config.settings)
+        compile_checks(config.registry.palantir_checks,
+                       config.registry.palantir_handlers)
     config.after_setup.append(post_setup_load_handlers)
 
 
@@ -211,17 +365,30 @@ def includeme(config):
     config.registry.palantir_handlers = load_handlers(settings)
 
     # Load the checks
-    config.registry.palantir_checks = load_checks(settings)
+    config.registry.palantir_check_loader = CheckLoader(settings)
+    config.registry.palantir_check_loader.scan()
+    config.registry.palantir_checks = \
+        config.registry.palantir_check_loader.checks()
+    compile_checks(config.registry.palantir_checks,
+                   config.registry.palantir_handlers)
+
+    # Cache the disabled checks and minions
+    config.registry.palantir_disabled = DisabledCache()
 
     # Set up the route urls
     config.add_route('palantir_list_checks', '/palantir/check/list')
     config.add_route('palantir_get_check', '/palantir/check/get')
     config.add_route('palantir_run_check', '/palantir/check/run')
     config.add_route('palantir_toggle_check', '/palantir/check/toggle')
+    config.add_route('palantir_list_check_profiles',
+                     '/palantir/check/profile/list')
+    config.add_route('palantir_get_check_profile',
+                     '/palantir/check/profile/get')
 
     config.add_route('palantir_list_alerts', '/palantir/alert/list')
     config.add_route('palantir_get_alert', '/palantir/alert/get')
     config.add_route('palantir_resolve_alert', '/palantir/alert/resolve')
+    config.add_route('palantir_alert_queue', '/palantir/alert/queue')
 
     config.add_route('palantir_list_minions', '/palantir/minion/list')
     config.add_route('palantir_get_minion', '/palantir/minion/get')
@@ -233,8 +400,13 @@ def includeme(config):
     config.add_route('palantir_list_minion_checks',
                      '/palantir/minion/check/list')
     config.add_route('palantir_get_minion_check', '/palantir/minion/check/get')
+    config.add_route('palantir_export_minion_checks',
+                     '/palantir/minion/check/export')
+    config.add_route('palantir_get_minion_check_history',
+                     '/palantir/minion/check/history')
 
     config.add_route('palantir_list_handlers', '/palantir/handler/list')
     config.add_route('palantir_prune', '/palantir/prune')
+    config.add_route('palantir_metrics', '/palantir/metrics')
 
     config.scan(__package__ + '.views')
@@ -0,0 +1,177 @@
+""" Asynchronous delivery of alerts """
+import json
+import threading
+import time
+
+from pyramid.settings import asbool
+
+
+DEFAULT_ALERT_QUEUE = 'palantir_alerts'
+
+
+class CircuitOpen(Exception):
+
+    """ Raised when a handler is not being called because it keeps failing """
+
+    def __init__(self, name, retry_in):
+        super(CircuitOpen, self).__init__(
+            "Circuit for handler '%s' is open for %.1fs" % (name, retry_in))
+        self.name = name
+        self.retry_in = retry_in
+
+
+class CircuitBreaker(object):
+
+    """
+    Stops calling a handler for a while after it fails repeatedly
+
+    Parameters
+    ----------
+    name : str
+        The name of the handler
+    threshold : int
+        Open the circuit after this many failures in a row
+    reset_timeout : float
+        Seconds to wait after the circuit opens before trying the handler
+        again
+
+    """
+    def __init__(self, name, threshold, reset_timeout):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        """
+        Make sure the handler may be called
+
+        After the reset timeout, a single call is let through. If it succeeds,
+        the circuit closes.
+
+        Raises
+        ------
+        exc : :exc:`.CircuitOpen`
+
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return
+            retry_in = self.opened_at + self.reset_timeout - time.time()
+            if retry_in > 0:
+                raise CircuitOpen(self.name, retry_in)
+            # Let one call through, and reopen if it fails
+            self.opened_at = time.time()
+
+    def success(self):
+        """ Record a successful call """
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        """ Record a failed call """
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
+
+
+_BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+def get_breaker(name, settings):
+    """ Get the process-wide circuit breaker for a handler """
+    with _BREAKERS_LOCK:
+        breaker = _BREAKERS.get(name)
+        if breaker is None:
+            breaker = _BREAKERS[name] = CircuitBreaker(
+                name,
+                int(settings.get('palantir.circuit_breaker.threshold', 5)),
+                float(settings.get('palantir.circuit_breaker.reset', 60)))
+        return breaker
+
+
+def async_alerts(settings):
+    """ Check if alert handlers should be run on the alert queue """
+    return asbool(settings.get('palantir.async_alerts', False))
+
+
+def alert_queue(settings):
+    """ Get the name of the celery queue for alert handlers """
+    return settings.get('palantir.alert_queue', DEFAULT_ALERT_QUEUE)
+
+
+def alert_queue_depth(celery, settings):
+    """
+    Get the number of alert deliveries waiting in the alert queue
+
+    Returns
+    -------
+    depth : int or None
+        None if the queue doesn't exist yet
+
+    """
+    with celery.connection() as conn:
+        try:
+            return conn.default_channel.queue_declare(
+                queue=alert_queue(settings), passive=True).message_count
+        except conn.channel_errors:
+            return None
+
+
+class CheckGroup(object):
+
+    """
+    Stand-in for a check when alerts from several checks are delivered at once
+
+    Handlers receive this as the ``check`` when a coalesced batch contains
+    results from more than one check. Use ``result.check`` to tell the results
+    apart.
+
+    Parameters
+    ----------
+    checks : list
+        The :class:`~steward_palantir.check.Check`s in the batch
+
+    """
+    def __init__(self, checks):
+        self.checks = checks
+        self.name = ', '.join(sorted(check.name for check in checks))
+        self.meta = {}
+
+    def __repr__(self):
+        return 'CheckGroup(%s)' % self.name
+
+
+def coalesce_window(settings):
+    """ Get the number of seconds to buffer alert events for (0 to disable) """
+    return float(settings.get('palantir.coalesce_window', 0))
+
+
+def handler_key(handlers, **kwargs):
+    """
+    Get the key that alert events are grouped by
+
+    Parameters
+    ----------
+    handlers : list
+        The handler specs of a check (see
+        :class:`~steward_palantir.check.Check`)
+    **kwargs : dict
+        Other arguments for the handlers
+
+    Returns
+    -------
+    key : str or None
+        None if there are no handlers, or if they can't be grouped because
+        some of them are not in the dict form
+
+    """
+    if not handlers or not all(isinstance(handler, dict) for handler in handlers):
+        return None
+    return json.dumps({'handlers': list(handlers), 'kwargs': kwargs},
+                      sort_keys=True)
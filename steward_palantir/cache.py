@@ -0,0 +1,81 @@
+""" Process-local caches of palantir state """
+import itertools
+import threading
+from collections import namedtuple
+
+from .models import CheckDisabled, MinionDisabled, DisabledVersion
+
+
+DisabledState = namedtuple('DisabledState', ['version', 'checks', 'minions'])
+
+
+class DisabledCache(object):
+
+    """
+    Cache of the names of all disabled checks and minions
+
+    The disabled tables change rarely but are read on every check run and by
+    most endpoints. Each process keeps a copy of them in memory along with the
+    value of the :class:`~steward_palantir.models.DisabledVersion` counter it
+    was loaded at. A lookup only costs a single primary key query for the
+    counter, and the tables are only re-read after some process has called
+    :meth:`invalidate`.
+
+    """
+    def __init__(self):
+        self._state = None
+        self._lock = threading.Lock()
+
+    def get(self, db):
+        """
+        Get the current disabled state
+
+        Parameters
+        ----------
+        db : :class:`sqlalchemy.orm.Session`
+
+        Returns
+        -------
+        state : :class:`.DisabledState`
+            Has ``checks`` and ``minions`` attributes, which are frozensets of
+            the disabled names
+
+        """
+        version = db.query(DisabledVersion.version).filter_by(id=1).scalar()
+        state = self._state
+        if state is not None and state.version == version:
+            return state
+        with self._lock:
+            state = DisabledState(
+                version,
+                frozenset(itertools.chain.from_iterable(
+                    db.query(CheckDisabled.name).all())),
+                frozenset(itertools.chain.from_iterable(
+                    db.query(MinionDisabled.name).all())),
+            )
+            self._state = state
+        return state
+
+    def check_disabled(self, db, name):
+        """ Check if a check is disabled """
+        return name in self.get(db).checks
+
+    def minion_disabled(self, db, name):
+        """ Check if a minion is disabled """
+        return name in self.get(db).minions
+
+    def invalidate(self, db):
+        """
+        Mark the disabled state as changed for all processes
+
+        This must be called in the same transaction as any change to the
+        disabled checks or minions.
+
+        """
+        updated = db.query(DisabledVersion)\
+            .filter_by(id=1)\
+            .update({DisabledVersion.version: DisabledVersion.version + 1},
+                    synchronize_session=False)
+        if not updated:
+            db.merge(DisabledVersion(1))
+        self._state = None
@@ -3,6 +3,8 @@ from __future__ import unicode_literals
 
 import logging
 
+from .metrics import METRICS
+
 
 LOG = logging.getLogger(__name__)
 
@@ -20,7 +22,9 @@ class Check(object):
         Keyword arguments to the 'cmd.run_all' salt module. 'cmd' must be
         specified.
     schedule : dict
-        Keyword arguments to the :class:`datetime.timedelta` constructor
+        Keyword arguments to the :class:`datetime.timedelta` constructor. May
+        also contain an ``adaptive`` dict (see
+        :func:`steward_palantir.scheduler.adaptive_schedule`).
     target : str
         The salt target string.
     expr_form : str, optional
@@ -37,10 +41,15 @@ class Check(object):
         Same form as ``handlers``. Only called when a alert is resolved.
     meta : dict, optional
         Dictionary of arbitrary metadata for the check
+    output_limit : int, optional
+        Maximum number of characters of stdout and stderr to store. The head
+        and tail of longer output is kept. Defaults to
+        ``palantir.output_limit``.
 
     """
     def __init__(self, name, command, schedule, target, expr_form=None,
-                 timeout=None, handlers=(), raised=(), resolved=(), meta=None):
+                 timeout=None, handlers=(), raised=(), resolved=(), meta=None,
+                 output_limit=None):
         self.name = unicode(name)
         self.target = target
         self.expr_form = expr_form
@@ -61,6 +70,9 @@ class Check(object):
         self.raised = raised
         self.resolved = resolved
         self.meta = meta or {}
+        self.output_limit = output_limit
+        self._handler_registry = None
+        self._compiled_handlers = {}
 
     def _get_handlers(self, task, action, normalized_retcode, results,
                       **kwargs):
@@ -72,18 +84,63 @@ class Check(object):
         else:
             raise ValueError("Unrecognized action '%s'" % action)
 
+    def compile_handlers(self, handler_registry):
+        """
+        Instantiate the handlers for this check ahead of time
+
+        The compiled ``handlers``, ``raised``, and ``resolved`` lists will be
+        reused every time the check is run.
+
+        Parameters
+        ----------
+        handler_registry : dict
+            Map of handler names to handler classes
+
+        Raises
+        ------
+        exc : :exc:`ValueError`
+            If the check references a handler that doesn't exist
+
+        """
+        self._handler_registry = handler_registry
+        self._compiled_handlers = {}
+        for handlers in (self.handlers, self.raised, self.resolved):
+            self._build_handlers(None, handlers)
+
     def _build_handlers(self, task, handlers):
-        """ Instantiate any handlers that are just the data representation """
+        """
+        Instantiate any handlers that are just the data representation
+
+        Only the ``handlers``, ``raised``, and ``resolved`` lists of the check
+        are cached. Other lists (e.g. from an overridden :meth:`._get_handlers`)
+        are built every time.
+
+        """
+        cacheable = any(handlers is own for own in
+                        (self.handlers, self.raised, self.resolved))
+        compiled = self._compiled_handlers.get(id(handlers))
+        # Make sure the id wasn't reused by a different list
+        if compiled is not None and compiled[0] is handlers:
+            return compiled[1]
+
+        handler_registry = self._handler_registry
+        if handler_registry is None:
+            handler_registry = task.config.registry.palantir_handlers
         handler_instances = []
         for handler in handlers:
             # If the handler is a data representation, construct it
             if isinstance(handler, dict):
                 name, args = handler.items()[0]
                 args = args or {}
-                handler_instances.append(
-                    task.config.registry.palantir_handlers[name](**args))
+                if name not in handler_registry:
+                    raise ValueError("Check '%s' uses unknown handler '%s'" %
+                                     (self.name, name))
+                handler_instances.append(handler_registry[name](**args))
             else:
                 handler_instances.append(handler)
+        if cacheable:
+            self._compiled_handlers[id(handlers)] = (handlers,
+                                                     handler_instances)
         return handler_instances
 
     def _run_alert_handler_list(self, task, normalized_retcode, results,
@@ -100,9 +157,10 @@ class Check(object):
         for handler in handlers:
             try:
                 LOG.debug("Running handler '%s'", handler)
-                handler_result = handler.handle_alert(task, self,
-                                                      normalized_retcode,
-                                                      results, **kwargs)
+                with METRICS.timer('palantir_handler_seconds',
+                                   handler=handler.name, kind='alert'):
+                    handler_result = handler.handle_alert(
+                        task, self, normalized_retcode, results, **kwargs)
                 if handler_result is not None:
                     # If the handler returns a list of results, only apply
                     # successive handlers to that list
@@ -138,21 +196,37 @@ class Check(object):
             List of all the check results that made it through all the handlers
 
         """
-        handlers = self._get_handlers(task, action, normalized_retcode,
-                                      results, **kwargs)
-
-        handlers = self._build_handlers(task, handlers)
+        handlers = self.get_alert_handlers(task, action, normalized_retcode,
+                                           results, **kwargs)
 
         return self._run_alert_handler_list(task, normalized_retcode,
                                             results, handlers, **kwargs)
 
+    def get_alert_handlers(self, task, action, normalized_retcode, results,
+                           **kwargs):
+        """
+        Get the handler instances to run when raising or resolving an alert
+
+        Takes the same parameters as :meth:`.run_alert_handlers`
+
+        Returns
+        -------
+        handlers : list
+
+        """
+        handlers = self._get_handlers(task, action, normalized_retcode,
+                                      results, **kwargs)
+        return self._build_handlers(task, handlers)
+
     def _run_handler_list(self, task, result, handlers, **kwargs):
         """ Run the handlers iteratively """
         for handler in handlers:
             try:
                 LOG.debug("Running handler '%s'", handler)
-                handler_result = handler.handle(task, self, result,
-                                                **kwargs)
+                with METRICS.timer('palantir_handler_seconds',
+                                   handler=handler.name, kind='check'):
+                    handler_result = handler.handle(task, self, result,
+                                                    **kwargs)
                 if handler_result is True:
                     return True
             except:
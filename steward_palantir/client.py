@@ -5,6 +5,10 @@ from pprint import pprint
 from steward.colors import green, red, yellow, magenta
 
 
+# Number of alerts to fetch per request
+ALERT_PAGE_SIZE = 200
+
+
 def _fuzzy_timedelta(td):
     """ Format a timedelta into a *loose* 'X time ago' string """
     ago_str = lambda x, y: '%d %s%s ago' % (x, y, 's' if x > 1 else '')
@@ -53,17 +57,34 @@ def _format_check_status(status):
     return string
 
 
-def do_alerts(client):
-    """ Print all active alerts """
-    response = client.cmd('palantir/alert/list').json()
-    # Sort by minion, then by check name
-    response.sort(key=lambda x: x['check'])
-    response.sort(key=lambda x: x['minion'])
-    for alert in response:
-        alert['name'] = alert['check']
-        color = yellow if alert['retcode'] == 1 else red
-        print "{} - {}".format(color(alert['minion']),
-                               _format_check_status(alert))
+def do_alerts(client, minion=None, check=None):
+    """
+    Print all active alerts
+
+    Parameters
+    ----------
+    minion : str, optional
+        Only print alerts for minions that match this glob
+    check : str, optional
+        Only print alerts for this check
+
+    """
+    params = {'order': 'minion', 'limit': ALERT_PAGE_SIZE}
+    if minion is not None:
+        params['minion'] = minion
+    if check is not None:
+        params['check'] = check
+    while True:
+        response = client.cmd('palantir/alert/list', **params)
+        for alert in response.json():
+            alert['name'] = alert['check']
+            color = yellow if alert['retcode'] == 1 else red
+            print "{} - {}".format(color(alert['minion']),
+                                   _format_check_status(alert))
+        cursor = response.headers.get('X-Palantir-Cursor')
+        if cursor is None:
+            break
+        params['cursor'] = cursor
 
 
 def do_checks(client, check=None):
@@ -129,7 +150,38 @@ def do_status(client, minion, check=None):
         print _format_check_status(response)
 
 
-def do_run_check(client, check):
+def do_history(client, minion, check, limit=20):
+    """
+    Print the recent history of a check on a minion
+
+    Parameters
+    ----------
+    minion : str
+        Name of the minion
+    check : str
+        Name of the check
+    limit : int, optional
+        Maximum number of entries to print (default 20)
+
+    """
+    response = client.cmd('palantir/minion/check/history', minion=minion,
+                          check=check, limit=limit).json()
+    for entry in response:
+        ran_at = datetime.fromtimestamp(entry['created'])
+        if entry['retcode'] == 0:
+            status = green("SUCCESS")
+        elif entry['retcode'] == 1:
+            status = yellow("WARNING")
+        else:
+            status = red("ERROR(%d)" % entry['retcode'])
+        line = '%s %s (%.2fs)' % (ran_at.isoformat(), status,
+                                  entry['duration'] or 0)
+        if entry['count'] > 1:
+            line += ' x%d' % entry['count']
+        print line
+
+
+def do_run_check(client, check, profile=False):
     """
     Run a Palantir check
 
@@ -137,9 +189,15 @@ def do_run_check(client, check):
     ----------
     check : str
         Name of the check to run
+    profile : bool, optional
+        Profile the run. The profile can be fetched from
+        palantir/check/profile/get.
 
     """
-    response = client.cmd('palantir/check/run', name=check).json()
+    params = {'name': check}
+    if profile:
+        params['profile'] = True
+    response = client.cmd('palantir/check/run', **params).json()
     if isinstance(response, basestring):
         print response
     else:
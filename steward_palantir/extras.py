@@ -1,7 +1,46 @@
 """ Extra handlers """
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
 from .handlers import BaseHandler
 
 
+LOG = logging.getLogger(__name__)
+
+# Twilio clients, keyed by (sid, token)
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_twilio_client(sid, token):
+    """
+    Get a long-lived twilio client for a set of credentials
+
+    The client is shared by every alert sent with those credentials, so the
+    underlying HTTP connections can be reused.
+
+    """
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get((sid, token))
+        if client is None:
+            try:
+                # twilio >= 6 keeps a pooled requests.Session per client
+                from twilio.rest import Client  # pylint: disable=F0401
+            except ImportError:
+                from twilio.rest import TwilioRestClient as Client  # pylint: disable=F0401
+            client = _CLIENTS[(sid, token)] = Client(sid, token)
+        return client
+
+
+class TwilioError(Exception):
+    """ Raised when an SMS could not be sent to some of the numbers """
+    def __init__(self, failed):
+        super(TwilioError, self).__init__("Could not send SMS to %s" %
+                                          ', '.join(failed))
+        self.failed = failed
+
+
 class TwilioHandler(BaseHandler): # pylint: disable=W0223
 
     """
@@ -23,6 +62,15 @@ class TwilioHandler(BaseHandler): # pylint: disable=W0223
         The phone number to send the SMS from (may be specified in config.ini
         as palantir.twilio.from_num)
 
+    Notes
+    -----
+    Messages to the different numbers are sent concurrently, up to
+    ``palantir.twilio.concurrency`` (default 4) at a time. A failure to send
+    to one number is logged and does not stop the others. If every send
+    failed (e.g. twilio is down), a :exc:`TwilioError` is raised so the
+    delivery can be retried. Numbers that did receive the SMS are never
+    retried, so they don't get it twice.
+
     """
     name = 'twilio'
 
@@ -32,26 +80,48 @@ class TwilioHandler(BaseHandler): # pylint: disable=W0223
         else:
             self.to = to
         if len(body) > 160:
-            self.body = self.body[:159] + u'\u2026'
+            self.body = body[:159] + u'\u2026'
         else:
             self.body = body
         self.sid = sid
         self.token = token
         self.from_num = from_num
 
+    def _send(self, client, to_num, from_num):
+        """ Send the SMS to one number, returning whether it succeeded """
+        # twilio >= 3.5 exposes messages on the client itself
+        messages = getattr(client, 'messages', None) or client.sms.messages
+        try:
+            messages.create(body=self.body, to=to_num, from_=from_num)
+            return True
+        except Exception:
+            LOG.exception("Error sending SMS to %s", to_num)
+            return False
+
     def handle_alert(self, task, check, normalized_retcode, results,
                      **kwargs):
-        token = task.config.settings.get('palantir.twilio.token',
-                                              self.token)
-        sid = task.config.settings.get('palantir.twilio.sid', self.sid)
-        from_num = task.config.settings.get('palantir.twilio.from_num',
-                                                 self.from_num)
-
-        from twilio.rest import TwilioRestClient  # pylint: disable=F0401
-        client = TwilioRestClient(sid, token)
-
-        for to_num in self.to:
-            client.sms.messages.create(
-                body=self.body,
-                to=to_num,
-                from_=from_num)
+        settings = task.config.settings
+        token = settings.get('palantir.twilio.token', self.token)
+        sid = settings.get('palantir.twilio.sid', self.sid)
+        from_num = settings.get('palantir.twilio.from_num', self.from_num)
+        concurrency = int(settings.get('palantir.twilio.concurrency', 4))
+
+        client = get_twilio_client(sid, token)
+        if len(self.to) <= 1 or concurrency <= 1:
+            sent = [self._send(client, to_num, from_num)
+                    for to_num in self.to]
+        else:
+            pool = ThreadPool(min(concurrency, len(self.to)))
+            try:
+                sent = pool.map(lambda to_num: self._send(client, to_num,
+                                                          from_num),
+                                self.to)
+            finally:
+                pool.close()
+                pool.join()
+        failed = [to_num for to_num, success in zip(self.to, sent)
+                  if not success]
+        if failed and len(failed) == len(self.to):
+            raise TwilioError(failed)
+        elif failed:
+            LOG.error("Could not send SMS to %s", ', '.join(failed))
@@ -1,4 +1,5 @@
 """ Check result handlers """
+import bisect
 import re
 
 import logging
@@ -22,24 +23,39 @@ class RangeSpec(object):
     """
     def __init__(self, spec):
         self.spec = str(spec)
-        self._ranges = self.spec.split(',')
+        intervals = []
+        if self.spec:
+            for intrange in self.spec.split(','):
+                intervals.append(self._parse_range(intrange))
+        intervals.sort()
+
+        # Merge overlapping intervals so they can be binary searched
+        self._starts = []
+        self._ends = []
+        for low, high in intervals:
+            if self._ends and low <= self._ends[-1]:
+                self._ends[-1] = max(self._ends[-1], high)
+            else:
+                self._starts.append(low)
+                self._ends.append(high)
+
+    @staticmethod
+    def _parse_range(intrange):
+        """ Parse a single number or range into an inclusive (low, high) """
+        try:
+            value = int(intrange)
+            return value, value
+        except ValueError:
+            split = intrange.split('-')
+            if len(split) == 2 and split[1]:
+                low, high = split
+                return int(low), int(high)
+            else:
+                return int(split[0]), float('inf')
 
     def __contains__(self, value):
-        if len(self.spec) == 0:
-            return False
-        for intrange in self._ranges:
-            try:
-                if value == int(intrange):
-                    return True
-            except ValueError:
-                split = intrange.split('-')
-                if len(split) == 2 and split[1]:
-                    low, high = split
-                    if int(low) <= value <= int(high):
-                        return True
-                else:
-                    if value >= int(split[0]):
-                        return True
+        i = bisect.bisect_right(self._starts, value) - 1
+        return i >= 0 and value <= self._ends[i]
 
     def __repr__(self):
         return "RangeSpec(%s)" % self.spec
@@ -99,7 +115,11 @@ class BaseHandler(object):
         results : list
             The list of :class:`steward_palantir.models.CheckResult`s to process
         **kwargs : dict
-            Other parameters for the handler
+            Other parameters for the handler. ``coalesced`` will be True if
+            the results were buffered and delivered together with others (see
+            ``palantir.coalesce_window``). In that case ``check`` may be a
+            :class:`steward_palantir.alerting.CheckGroup` and the results may
+            come from several checks.
 
         Returns
         -------
@@ -220,6 +240,9 @@ class AbsorbHandler(BaseHandler):
         self.out_match = out_match
         self.err_match = err_match
         self.any_match = any_match
+        self._out_re = re.compile(out_match) if out_match else None
+        self._err_re = re.compile(err_match) if err_match else None
+        self._any_re = re.compile(any_match) if any_match else None
         if retcodes is not None:
             self.retcodes = RangeSpec(retcodes)
         else:
@@ -245,13 +268,13 @@ class AbsorbHandler(BaseHandler):
         if self.count > 1 and result.count >= self.count:
             return False
 
-        if self.out_match and not re.match(self.out_match, result.stdout):
+        if self._out_re and not self._out_re.match(result.stdout):
             return False
-        if self.err_match and not re.match(self.err_match, result.stderr):
+        if self._err_re and not self._err_re.match(result.stderr):
             return False
-        if self.any_match and not \
-            (re.match(self.any_match, result.stdout) or
-             re.match(self.any_match, result.stderr)):
+        if self._any_re and not \
+            (self._any_re.match(result.stdout) or
+             self._any_re.match(result.stderr)):
             return False
 
         if self.retcodes is not None and result.retcode not in self.retcodes:
@@ -0,0 +1,180 @@
+""" Bounded history of check results """
+import logging
+from datetime import datetime, timedelta
+
+import transaction
+from sqlalchemy import bindparam
+from sqlalchemy.orm import aliased
+
+from .models import CheckHistory, BULK_BATCH_SIZE
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _get_int(settings, key, default):
+    """ Get an integer setting """
+    return int(settings.get(key, default))
+
+
+def history_enabled(settings):
+    """ Check if the check history is being recorded """
+    return _get_int(settings, 'palantir.history.max_entries', 0) > 0
+
+
+def append_history(db, entries):
+    """
+    Append entries to the check history
+
+    Parameters
+    ----------
+    db : :class:`sqlalchemy.orm.Session`
+    entries : list
+        List of dicts with the ``minion``, ``check``, ``retcode``,
+        ``fingerprint``, ``created``, and ``duration`` of each run
+
+    """
+    table = CheckHistory.__table__
+    for entry in entries:
+        entry.setdefault('count', 1)
+        entry.setdefault('resolution', 0)
+    for i in xrange(0, len(entries), BULK_BATCH_SIZE):
+        db.execute(table.insert(), entries[i:i + BULK_BATCH_SIZE])
+
+
+def downsample_history(db, check_name, cutoff, resolution):
+    """
+    Merge old history entries with the same outcome
+
+    All entries for a minion older than ``cutoff`` that fall into the same
+    time bucket and have the same retcode and output are merged into the
+    first of them.
+
+    Parameters
+    ----------
+    db : :class:`sqlalchemy.orm.Session`
+    check_name : str
+    cutoff : :class:`datetime.datetime`
+        Only downsample entries older than this
+    resolution : int
+        The size in seconds of the time buckets
+
+    Returns
+    -------
+    deleted : int
+        The number of entries that were merged away
+
+    """
+    groups = {}
+    query = db.query(CheckHistory.id, CheckHistory.minion,
+                     CheckHistory.retcode, CheckHistory.fingerprint,
+                     CheckHistory.created, CheckHistory.duration,
+                     CheckHistory.count)\
+        .filter_by(check=check_name, resolution=0)\
+        .filter(CheckHistory.created < cutoff)\
+        .order_by(CheckHistory.created)
+    epoch = datetime.fromtimestamp(0)
+    for entry_id, minion, retcode, fingerprint, created, duration, count in \
+            query.yield_per(BULK_BATCH_SIZE):
+        age = created - epoch
+        bucket = (age.days * 86400 + age.seconds) // resolution
+        key = (minion, bucket, retcode, fingerprint)
+        group = groups.get(key)
+        if group is None:
+            groups[key] = [entry_id, count, (duration or 0) * count, []]
+        else:
+            group[1] += count
+            group[2] += (duration or 0) * count
+            group[3].append(entry_id)
+
+    table = CheckHistory.__table__
+    updates = [{'_id': entry_id, '_count': count,
+                '_duration': total_duration / count}
+               for entry_id, count, total_duration, _ in groups.itervalues()]
+    for i in xrange(0, len(updates), BULK_BATCH_SIZE):
+        db.execute(table.update()
+                   .where(table.c.id == bindparam('_id'))
+                   .values(count=bindparam('_count'),
+                           duration=bindparam('_duration'),
+                           resolution=resolution),
+                   updates[i:i + BULK_BATCH_SIZE])
+
+    merged = [entry_id for group in groups.itervalues()
+              for entry_id in group[3]]
+    for i in xrange(0, len(merged), BULK_BATCH_SIZE):
+        db.query(CheckHistory)\
+            .filter(CheckHistory.id.in_(merged[i:i + BULK_BATCH_SIZE]))\
+            .delete(synchronize_session=False)
+    return len(merged)
+
+
+def trim_history(db, check_name, max_entries):
+    """
+    Delete the oldest history entries past the limit for each minion
+
+    The entries are found with a single query per batch, which compares each
+    entry to the id of the newest entry past the limit on its minion. The
+    transaction is committed after each batch.
+
+    Returns
+    -------
+    deleted : int
+
+    """
+    newer = aliased(CheckHistory)
+    threshold = db.query(newer.id)\
+        .filter(newer.check == CheckHistory.check,
+                newer.minion == CheckHistory.minion)\
+        .order_by(newer.id.desc())\
+        .offset(max_entries).limit(1)\
+        .correlate(CheckHistory).as_scalar()
+    deleted = 0
+    while True:
+        ids = [entry_id for (entry_id,) in db.query(CheckHistory.id)
+               .filter(CheckHistory.check == check_name,
+                       CheckHistory.id <= threshold)
+               .limit(BULK_BATCH_SIZE)]
+        if not ids:
+            return deleted
+        deleted += db.query(CheckHistory)\
+            .filter(CheckHistory.id.in_(ids))\
+            .delete(synchronize_session=False)
+        transaction.commit()
+
+
+def prune_history(db, settings, check_names):
+    """
+    Enforce the retention settings on the check history
+
+    The transaction is committed after each check is downsampled and after
+    each batch of entries is trimmed, so this never holds locks for long.
+
+    Parameters
+    ----------
+    db : :class:`sqlalchemy.orm.Session`
+    settings : dict
+    check_names : list
+        Names of all current checks
+
+    Returns
+    -------
+    stats : dict
+        Map of check name to the number of entries removed
+
+    """
+    max_entries = _get_int(settings, 'palantir.history.max_entries', 0)
+    if max_entries <= 0:
+        return {}
+    cutoff = datetime.now() - timedelta(hours=_get_int(
+        settings, 'palantir.history.downsample_after', 24))
+    resolution = _get_int(settings, 'palantir.history.resolution', 3600)
+    stats = {}
+    for check_name in check_names:
+        removed = downsample_history(db, check_name, cutoff, resolution)
+        transaction.commit()
+        removed += trim_history(db, check_name, max_entries)
+        if removed:
+            LOG.debug("Pruned %d history entries for '%s'", removed,
+                      check_name)
+        stats[check_name] = removed
+    return stats
@@ -0,0 +1,276 @@
+"""
+Metrics about running checks
+
+Each process collects counters and histograms in memory and periodically adds
+them to the ``palantir_metrics`` table, so the values from all the Celery
+workers can be served together from ``palantir/metrics`` in the Prometheus
+text format.
+
+"""
+import bisect
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from .models import MetricValue
+
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+           30, 60, 120)
+
+# Map of metric names to (type, help)
+METRIC_TYPES = {
+    'palantir_check_run_seconds': (
+        'histogram', "Time to run a check (or one shard of a check)"),
+    'palantir_salt_seconds': (
+        'histogram', "Time spent waiting for salt during a check run"),
+    'palantir_db_seconds': (
+        'histogram', "Time spent in database queries during a check run"),
+    'palantir_minions_total': (
+        'counter', "Minions that were matched, responded, or timed out"),
+    'palantir_handle_results_seconds': (
+        'histogram', "Time to raise or resolve the alerts of a check run"),
+    'palantir_alert_handlers_seconds': (
+        'histogram', "Time to run the raised or resolved handlers of a check"),
+    'palantir_handler_seconds': (
+        'histogram', "Time to run a single handler"),
+    'palantir_alerts_total': (
+        'counter', "Alerts raised and resolved"),
+}
+
+_DB_TIME = threading.local()
+_TRACKED_ENGINES = set()
+
+
+def _format_labels(labels):
+    """ Format labels in the exposition format, sorted by name """
+    return ','.join('%s="%s"' % (key, unicode(labels[key])
+                                 .replace('\\', '\\\\').replace('"', '\\"')
+                                 .replace('\n', '\\n'))
+                    for key in sorted(labels))
+
+
+def _format_bound(bound):
+    """ Format a bucket bound in the exposition format """
+    if bound == float('inf'):
+        return '+Inf'
+    return repr(float(bound))
+
+
+class Metrics(object):
+
+    """
+    Collects metrics in memory until they are flushed to the database
+
+    Histogram buckets are kept as counts per bucket. They are made cumulative
+    when rendered.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = defaultdict(float)
+        self._last_flush = time.time()
+
+    def inc(self, name, value=1, **labels):
+        """ Increment a counter """
+        key = (name, _format_labels(labels))
+        with self._lock:
+            self._pending[key] += value
+
+    def observe(self, name, value, **labels):
+        """ Add an observation to a histogram """
+        index = bisect.bisect_left(BUCKETS, value)
+        bound = BUCKETS[index] if index < len(BUCKETS) else float('inf')
+        bucket_labels = dict(labels, le=_format_bound(bound))
+        formatted = _format_labels(labels)
+        with self._lock:
+            self._pending[(name + '_bucket',
+                           _format_labels(bucket_labels))] += 1
+            self._pending[(name + '_sum', formatted)] += value
+            self._pending[(name + '_count', formatted)] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Context manager that observes how long its block takes """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def flush(self, db, settings, force=False):
+        """
+        Add the collected metrics to the database
+
+        Parameters
+        ----------
+        db : :class:`sqlalchemy.orm.Session`
+        settings : dict
+            Uses ``palantir.metrics.flush_interval`` (default 10). This does
+            nothing if fewer seconds have passed since the last flush.
+        force : bool, optional
+            Flush even if the interval hasn't passed
+
+        """
+        interval = float(settings.get('palantir.metrics.flush_interval', 10))
+        with self._lock:
+            if not force and time.time() - self._last_flush < interval:
+                return
+            pending, self._pending = self._pending, defaultdict(float)
+            self._last_flush = time.time()
+        for (name, labels), delta in sorted(pending.iteritems()):
+            updated = db.query(MetricValue)\
+                .filter_by(name=name, labels=labels)\
+                .update({MetricValue.value: MetricValue.value + delta},
+                        synchronize_session=False)
+            if updated:
+                continue
+            savepoint = db.begin_nested()
+            try:
+                db.execute(MetricValue.__table__.insert(),
+                           {'name': name, 'labels': labels, 'value': delta})
+                savepoint.commit()
+            except IntegrityError:
+                # Another process created it first
+                savepoint.rollback()
+                db.query(MetricValue)\
+                    .filter_by(name=name, labels=labels)\
+                    .update({MetricValue.value: MetricValue.value + delta},
+                            synchronize_session=False)
+
+
+METRICS = Metrics()
+
+
+def track_db_time(db):
+    """ Start measuring the time spent in queries on a session's engine """
+    engine = db.get_bind()
+    if id(engine) in _TRACKED_ENGINES:
+        return
+    _TRACKED_ENGINES.add(id(engine))
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_execute(*_):
+        """ Note when the query started """
+        _DB_TIME.start = time.time()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_execute(*_):
+        """ Add the duration of the query to the total """
+        _DB_TIME.total = db_seconds() + time.time() - _DB_TIME.start
+
+
+def db_seconds():
+    """ Total seconds spent in queries on this thread """
+    return getattr(_DB_TIME, 'total', 0.0)
+
+
+def render(rows, gauges=None):
+    """
+    Render metrics in the Prometheus text exposition format
+
+    Parameters
+    ----------
+    rows : list
+        List of :class:`~steward_palantir.models.MetricValue`
+    gauges : dict, optional
+        Map of name to (help, value) for gauges computed at scrape time
+
+    Returns
+    -------
+    text : str
+
+    """
+    samples = defaultdict(list)
+    for row in rows:
+        for family in METRIC_TYPES:
+            if row.name == family or (row.name.startswith(family + '_') and
+                                      row.name[len(family) + 1:] in
+                                      ('bucket', 'sum', 'count')):
+                samples[family].append(row)
+                break
+
+    lines = []
+    for family in sorted(samples):
+        metric_type, helptext = METRIC_TYPES[family]
+        lines.append('# HELP %s %s' % (family, helptext))
+        lines.append('# TYPE %s %s' % (family, metric_type))
+        if metric_type == 'histogram':
+            lines.extend(_render_histogram(family, samples[family]))
+        else:
+            for row in sorted(samples[family], key=lambda r: r.labels):
+                lines.append(_sample(row.name, row.labels, row.value))
+
+    for name, (helptext, value) in sorted((gauges or {}).iteritems()):
+        lines.append('# HELP %s %s' % (name, helptext))
+        lines.append('# TYPE %s gauge' % name)
+        lines.append(_sample(name, '', value))
+    return '\n'.join(lines) + '\n'
+
+
+def _sample(name, labels, value):
+    """ Format a single sample line """
+    if labels:
+        return '%s{%s} %s' % (name, labels, repr(float(value)))
+    return '%s %s' % (name, repr(float(value)))
+
+
+def _render_histogram(family, rows):
+    """ Render the cumulative buckets, sum and count of a histogram """
+    buckets = defaultdict(dict)
+    totals = defaultdict(dict)
+    for row in rows:
+        if row.name == family + '_bucket':
+            labels = dict(pair.split('=', 1) for pair in
+                          _split_labels(row.labels))
+            bound = float(labels.pop('le').strip('"'))
+            buckets[_format_labels_raw(labels)][bound] = row.value
+        else:
+            totals[row.labels][row.name] = row.value
+
+    lines = []
+    for labels in sorted(set(buckets) | set(totals)):
+        counts = buckets.get(labels, {})
+        cumulative = 0
+        for bound in BUCKETS + (float('inf'),):
+            cumulative += counts.get(bound, 0)
+            bucket_labels = labels + ',' if labels else ''
+            bucket_labels += 'le="%s"' % _format_bound(bound)
+            lines.append(_sample(family + '_bucket', bucket_labels,
+                                 cumulative))
+        for suffix in ('_sum', '_count'):
+            lines.append(_sample(family + suffix, labels,
+                                 totals[labels].get(family + suffix, 0)))
+    return lines
+
+
+def _split_labels(labels):
+    """ Split a formatted label string into 'key="value"' pairs """
+    pairs = []
+    current = ''
+    quoted = escaped = False
+    for char in labels:
+        if char == ',' and not quoted:
+            pairs.append(current)
+            current = ''
+            continue
+        current += char
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '"':
+            quoted = not quoted
+    if current:
+        pairs.append(current)
+    return pairs
+
+
+def _format_labels_raw(labels):
+    """ Join already-formatted label values, sorted by name """
+    return ','.join('%s=%s' % (key, labels[key]) for key in sorted(labels))
@@ -1,13 +1,100 @@
 """ SQLAlchemy models """
+import hashlib
+import json
 from datetime import datetime
 
-from sqlalchemy import Column, Integer, DateTime, UnicodeText, Boolean
+from sqlalchemy import (Column, Integer, DateTime, UnicodeText, Boolean,
+                        String, Float, Index, LargeBinary)
+from sqlalchemy.exc import IntegrityError
 
 from steward_sqlalchemy import declarative_base
 
+from .output import (compress_output, decompress_output, to_unicode,
+                     truncate_output)
+
 
 Base = declarative_base() # pylint: disable=C0103
 
+# Maximum number of rows to touch in a single bulk statement
+BULK_BATCH_SIZE = 500
+
+
+def output_fingerprint(stdout, stderr):
+    """ Get a hash of the output of a check """
+    digest = hashlib.sha1()
+    for text in (stdout or '', '\0', stderr or ''):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        digest.update(text)
+    return digest.hexdigest()
+
+
+class OutputMixin(object):
+    """
+    Stores ``stdout`` and ``stderr`` compressed if they are large
+
+    The output is only decompressed when the attributes are first read, and
+    the decoded value is kept on the instance until the column changes.
+
+    """
+    _stdout = Column('stdout', UnicodeText())
+    _stderr = Column('stderr', UnicodeText())
+
+    def _get_output(self, attr):
+        """ Decode a stored output column, caching the result """
+        stored = getattr(self, attr)
+        cache = getattr(self, attr + '_cache', None)
+        if cache is None or cache[0] is not stored:
+            cache = (stored, decompress_output(stored))
+            setattr(self, attr + '_cache', cache)
+        return cache[1]
+
+    def set_output(self, stdout, stderr, limit=0, store=True):
+        """
+        Set the output, storing at most ``limit`` characters of each stream
+
+        Until the columns change, reading ``stdout`` and ``stderr`` returns
+        the full output that was set here.
+
+        Parameters
+        ----------
+        stdout : str
+        stderr : str
+        limit : int, optional
+            See :func:`~steward_palantir.output.truncate_output`
+        store : bool, optional
+            If False, leave the stored columns alone (e.g. because they
+            already hold this output)
+
+        """
+        for attr, text in (('_stdout', stdout), ('_stderr', stderr)):
+            text = to_unicode(text)
+            if store:
+                setattr(self, attr,
+                        compress_output(truncate_output(text, limit)))
+            setattr(self, attr + '_cache', (getattr(self, attr), text))
+
+    @property
+    def stdout(self):
+        """ The stdout of the check """
+        return self._get_output('_stdout')
+
+    @stdout.setter
+    def stdout(self, value):
+        """ Setter for stdout """
+        self._stdout = compress_output(value)
+
+    @property
+    def stderr(self):
+        """ The stderr of the check """
+        return self._get_output('_stderr')
+
+    @stderr.setter
+    def stderr(self, value):
+        """ Setter for stderr """
+        self._stderr = compress_output(value)
+
+
 class CheckDisabled(Base):
     """
     Mark a check as disabled
@@ -50,7 +137,7 @@ class MinionDisabled(Base):
         self.name = name
 
 
-class Alert(Base):
+class Alert(OutputMixin, Base):
     """
     A check result that has caused an alert
 
@@ -79,10 +166,8 @@ class Alert(Base):
     id = Column(Integer(), primary_key=True)
     minion = Column(UnicodeText(), nullable=False, index=True)
     check = Column(UnicodeText(), nullable=False, index=True)
-    stdout = Column(UnicodeText())
-    stderr = Column(UnicodeText())
     retcode = Column(Integer())
-    created = Column(DateTime())
+    created = Column(DateTime(), index=True)
 
     def __init__(self, minion, check, stdout, stderr, retcode):
         self.minion = minion
@@ -95,8 +180,11 @@ class Alert(Base):
     @classmethod
     def from_result(cls, result):
         """ Create an Alert from a CheckResult """
-        return cls(result.minion, result.check, result.stdout, result.stderr,
-                   result.retcode)
+        alert = cls(result.minion, result.check, None, None, result.retcode)
+        # Copy the stored form so it doesn't need to be decompressed
+        alert._stdout = result._stdout  # pylint: disable=W0212
+        alert._stderr = result._stderr  # pylint: disable=W0212
+        return alert
 
     def __json__(self, request=None):
         return {
@@ -109,7 +197,7 @@ class Alert(Base):
         }
 
 
-class CheckResult(Base):
+class CheckResult(OutputMixin, Base):
     """
     The results of running a check on a minion
 
@@ -127,6 +215,8 @@ class CheckResult(Base):
     stdout : str
     stderr : str
     retcode : int
+    fingerprint : str
+        Hash of the stdout and stderr (see :func:`.output_fingerprint`)
     last_run : :class:`datetime.datetime`
         The time at which this check was last run
     count : int
@@ -140,12 +230,15 @@ class CheckResult(Base):
 
     """
     __tablename__ = 'palantir_check_results'
+    __table_args__ = (
+        Index('ix_palantir_check_results_check_minion', 'check', 'minion',
+              unique=True),
+    )
     id = Column(Integer(), primary_key=True)
     minion = Column(UnicodeText(), nullable=False, index=True)
-    check = Column(UnicodeText(), nullable=False, index=True)
-    stdout = Column(UnicodeText())
-    stderr = Column(UnicodeText())
+    check = Column(UnicodeText(), nullable=False)
     retcode = Column(Integer())
+    fingerprint = Column(String(40))
     last_run = Column(DateTime())
     count = Column(Integer(), nullable=False)
     alert = Column(Integer(), index=True)
@@ -161,6 +254,74 @@ class CheckResult(Base):
         self.old_result = None
         self.last_run = datetime.fromtimestamp(0)
 
+    @classmethod
+    def from_json(cls, data):
+        """
+        Create a transient CheckResult from its json data
+
+        The result is not attached to a session, so it is only useful for
+        passing to handlers.
+
+        """
+        result = cls(data['minion'], data['check'])
+        result.stdout = data['stdout']
+        result.stderr = data['stderr']
+        result.retcode = data['retcode']
+        result.last_run = datetime.fromtimestamp(data['last_run'])
+        result.count = data['count']
+        result.alert = data['alert']
+        result.enabled = data['enabled']
+        return result
+
+    @classmethod
+    def bulk_create(cls, db, keys, **kwargs):
+        """
+        Insert new results in bulk
+
+        The rows are inserted with one statement per batch. If some of them
+        were created concurrently, the rest are inserted one at a time.
+
+        Parameters
+        ----------
+        db : :class:`sqlalchemy.orm.Session`
+        keys : list
+            List of (minion, check) tuples. Any that already exist are
+            skipped.
+        **kwargs : dict
+            Values to set on the new rows other than the defaults
+
+        """
+        rows = []
+        for minion, check in keys:
+            row = {
+                'minion': minion,
+                'check': check,
+                'count': 1,
+                'enabled': True,
+                'alert': 0,
+                'retcode': 0,
+                'last_run': datetime.fromtimestamp(0),
+            }
+            row.update(kwargs)
+            rows.append(row)
+
+        table = cls.__table__
+        for i in xrange(0, len(rows), BULK_BATCH_SIZE):
+            batch = rows[i:i + BULK_BATCH_SIZE]
+            savepoint = db.begin_nested()
+            try:
+                db.execute(table.insert(), batch)
+                savepoint.commit()
+            except IntegrityError:
+                savepoint.rollback()
+                for row in batch:
+                    savepoint = db.begin_nested()
+                    try:
+                        db.execute(table.insert(), row)
+                        savepoint.commit()
+                    except IntegrityError:
+                        savepoint.rollback()
+
     def __json__(self, request=None):
         return {
             'minion': self.minion,
@@ -181,3 +342,320 @@ class CheckResult(Base):
             return self.retcode
         else:
             return 2
+
+
+class DisabledVersion(Base):
+    """
+    Counter that is bumped every time the disabled checks or minions change
+
+    Processes use this to tell when their cached copy of the disabled state is
+    stale (see :class:`steward_palantir.cache.DisabledCache`).
+
+    Parameters
+    ----------
+    version : int
+
+    Attributes
+    ----------
+    id : int
+        Always 1. There is only a single row.
+    version : int
+
+    """
+    __tablename__ = 'palantir_disabled_version'
+    id = Column(Integer(), primary_key=True)
+    version = Column(Integer(), nullable=False)
+
+    def __init__(self, version):
+        self.id = 1
+        self.version = version
+
+
+class CheckHistory(Base):
+    """
+    A record of the outcome of a check run on a minion
+
+    Old entries are downsampled by merging runs with the same outcome into a
+    single entry (see :mod:`steward_palantir.history`).
+
+    Parameters
+    ----------
+    minion : str
+        Name of the minion
+    check : str
+        Name of the check
+    retcode : int
+    fingerprint : str
+        Hash of the output (see :func:`.output_fingerprint`)
+    created : :class:`datetime.datetime`
+    duration : float
+
+    Attributes
+    ----------
+    minion : str
+    check : str
+    retcode : int
+    fingerprint : str
+    created : :class:`datetime.datetime`
+        The time of the (first) run
+    duration : float
+        Seconds from the start of the check run until this result was
+        processed. With ``palantir.stream_results`` this is close to how long
+        the minion took to respond. Otherwise it includes the wait for all the
+        minions. For downsampled entries, this is the average.
+    count : int
+        The number of runs this entry represents
+    resolution : int
+        The size in seconds of the time bucket that this entry was downsampled
+        into. 0 if the entry has not been downsampled.
+
+    """
+    __tablename__ = 'palantir_check_history'
+    __table_args__ = (
+        Index('ix_palantir_check_history_check_minion', 'check', 'minion',
+              'id'),
+    )
+    id = Column(Integer(), primary_key=True)
+    minion = Column(UnicodeText(), nullable=False)
+    check = Column(UnicodeText(), nullable=False)
+    retcode = Column(Integer())
+    fingerprint = Column(String(40))
+    created = Column(DateTime(), index=True)
+    duration = Column(Float())
+    count = Column(Integer(), nullable=False)
+    resolution = Column(Integer(), nullable=False)
+
+    def __init__(self, minion, check, retcode, fingerprint, created,
+                 duration):
+        self.minion = minion
+        self.check = check
+        self.retcode = retcode
+        self.fingerprint = fingerprint
+        self.created = created
+        self.duration = duration
+        self.count = 1
+        self.resolution = 0
+
+    def __json__(self, request=None):
+        return {
+            'minion': self.minion,
+            'check': self.check,
+            'retcode': self.retcode,
+            'fingerprint': self.fingerprint,
+            'created': float(self.created.strftime('%s.%f')),
+            'duration': self.duration,
+            'count': self.count,
+            'resolution': self.resolution,
+        }
+
+
+class SchedulerState(Base):
+    """
+    Persistent state of the palantir check scheduler
+
+    Parameters
+    ----------
+    last_tick : float
+        Unix timestamp of the last scheduler tick
+
+    Attributes
+    ----------
+    id : int
+        Always 1. There is only a single row.
+    last_tick : float
+
+    """
+    __tablename__ = 'palantir_scheduler'
+    id = Column(Integer(), primary_key=True)
+    last_tick = Column(Float(), nullable=False)
+
+    def __init__(self, last_tick):
+        self.id = 1
+        self.last_tick = last_tick
+
+
+class ShardedRun(Base):
+    """
+    Marks a sharded run of a check that hasn't been merged yet
+
+    Parameters
+    ----------
+    check : str
+        Name of the check
+    started : float
+        Unix timestamp of when the shards were dispatched
+
+    """
+    __tablename__ = 'palantir_sharded_runs'
+    check = Column(UnicodeText(), primary_key=True)
+    started = Column(Float(), nullable=False)
+
+    def __init__(self, check, started):
+        self.check = check
+        self.started = started
+
+
+class CheckSchedule(Base):
+    """
+    The current schedule of a check that uses an adaptive schedule
+
+    Parameters
+    ----------
+    check : str
+        Name of the check
+    interval : float
+        Seconds between runs
+
+    Attributes
+    ----------
+    check : str
+    interval : float
+    next_run : float
+        Unix timestamp of when the check should run next
+    stable_runs : int
+        Number of successful runs since the interval last changed
+
+    """
+    __tablename__ = 'palantir_check_schedules'
+    check = Column(UnicodeText(), primary_key=True)
+    interval = Column(Float(), nullable=False)
+    next_run = Column(Float(), nullable=False)
+    stable_runs = Column(Integer(), nullable=False)
+
+    def __init__(self, check, interval):
+        self.check = check
+        self.interval = interval
+        self.next_run = 0
+        self.stable_runs = 0
+
+    def __json__(self, request=None):
+        return {
+            'check': self.check,
+            'interval': self.interval,
+            'next_run': self.next_run,
+            'stable_runs': self.stable_runs,
+        }
+
+
+class PendingAlert(Base):
+    """
+    An alert event waiting to be delivered with others like it
+
+    Parameters
+    ----------
+    check : str
+        Name of the check
+    action : str
+        'raise' or 'resolve'
+    normalized_retcode : int
+    handlers : str
+        JSON key of the handler specs and arguments. Events with the same
+        ``action``, ``normalized_retcode`` and ``handlers`` are delivered
+        together.
+    results : str
+        JSON list of the data of the
+        :class:`~steward_palantir.models.CheckResult`s
+
+    Attributes
+    ----------
+    check : str
+    action : str
+    normalized_retcode : int
+    handlers : str
+    results : str
+    created : :class:`datetime.datetime`
+
+    """
+    __tablename__ = 'palantir_pending_alerts'
+    id = Column(Integer(), primary_key=True)
+    check = Column(UnicodeText(), nullable=False)
+    action = Column(UnicodeText(), nullable=False)
+    normalized_retcode = Column(Integer(), nullable=False)
+    handlers = Column(UnicodeText(), nullable=False)
+    results = Column(UnicodeText(), nullable=False)
+    created = Column(DateTime(), nullable=False)
+
+    def __init__(self, check, action, normalized_retcode, handlers, results):
+        self.check = check
+        self.action = action
+        self.normalized_retcode = normalized_retcode
+        self.handlers = handlers
+        self.results = results
+        self.created = datetime.now()
+
+
+class MetricValue(Base):
+    """
+    The value of one sample of a metric, summed across all processes
+
+    See :mod:`steward_palantir.metrics`
+
+    Attributes
+    ----------
+    name : str
+        Name of the sample (e.g. 'palantir_check_run_seconds_count')
+    labels : str
+        Labels of the sample in the exposition format (e.g. 'check="foo"')
+    value : float
+
+    """
+    __tablename__ = 'palantir_metrics'
+    name = Column(UnicodeText(), primary_key=True)
+    labels = Column(UnicodeText(), primary_key=True)
+    value = Column(Float(), nullable=False)
+
+    def __init__(self, name, labels, value):
+        self.name = name
+        self.labels = labels
+        self.value = value
+
+
+class CheckProfile(Base):
+    """
+    The profile of a single run of a check
+
+    See :mod:`steward_palantir.profiling`
+
+    Parameters
+    ----------
+    check : str
+        Name of the check
+    duration : float
+        Length of the run in seconds
+    summary : str
+        JSON summary of the slowest functions and queries
+    data : str
+        The profile in the pstats format
+
+    Attributes
+    ----------
+    check : str
+    duration : float
+    summary : str
+    data : str
+    created : :class:`datetime.datetime`
+
+    """
+    __tablename__ = 'palantir_check_profiles'
+    id = Column(Integer(), primary_key=True)
+    check = Column(UnicodeText(), nullable=False, index=True)
+    created = Column(DateTime(), nullable=False)
+    duration = Column(Float(), nullable=False)
+    summary = Column(UnicodeText(), nullable=False)
+    data = Column(LargeBinary(), nullable=False)
+
+    def __init__(self, check, duration, summary, data):
+        self.check = check
+        self.duration = duration
+        self.summary = summary
+        self.data = data
+        self.created = datetime.now()
+
+    def __json__(self, request=None):
+        return {
+            'id': self.id,
+            'check': self.check,
+            'created': float(self.created.strftime('%s.%f')),
+            'duration': self.duration,
+            'summary': json.loads(self.summary),
+        }
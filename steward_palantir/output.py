@@ -0,0 +1,92 @@
+""" Bounding and compressing the stored output of checks """
+import base64
+import zlib
+
+
+# Stored output that starts with this is compressed
+COMPRESSED_PREFIX = u'\x1bzlib:'
+
+# Output longer than this many characters is compressed when stored
+COMPRESS_THRESHOLD = 4096
+
+TRUNCATION_MARKER = u'\n<< %d characters truncated >>\n'
+
+
+def output_limit(check, settings):
+    """
+    Get the maximum number of characters of stdout and stderr to store
+
+    Parameters
+    ----------
+    check : :class:`~steward_palantir.check.Check`
+    settings : dict
+
+    Returns
+    -------
+    limit : int
+        The ``output_limit`` of the check, or ``palantir.output_limit``
+        (default 65536). 0 means unlimited.
+
+    """
+    if check.output_limit is not None:
+        return int(check.output_limit)
+    return int(settings.get('palantir.output_limit', 65536))
+
+
+def to_unicode(text):
+    """ Decode byte strings as UTF-8 """
+    if isinstance(text, str):
+        return text.decode('utf-8', 'replace')
+    return text
+
+
+def truncate_output(text, limit):
+    """
+    Keep the head and tail of some output that is over a limit
+
+    Parameters
+    ----------
+    text : str
+        Byte strings are decoded as UTF-8
+    limit : int
+        The maximum number of characters to keep. The marker noting the
+        truncation is added on top of this. 0 means unlimited.
+
+    Returns
+    -------
+    text : unicode
+
+    """
+    text = to_unicode(text)
+    if not text or limit <= 0 or len(text) <= limit:
+        return text
+    head = limit // 2
+    tail = limit - head
+    return (text[:head] + TRUNCATION_MARKER % (len(text) - limit) +
+            (text[-tail:] if tail else u''))
+
+
+def compress_output(text):
+    """
+    Get the form of some output to store in the database
+
+    Output over :data:`COMPRESS_THRESHOLD` characters is compressed
+
+    """
+    if text is None:
+        return None
+    text = to_unicode(text)
+    # Always compress text that looks compressed so it can't be misread
+    if (len(text) <= COMPRESS_THRESHOLD and
+            not text.startswith(COMPRESSED_PREFIX)):
+        return text
+    data = zlib.compress(text.encode('utf-8'))
+    return COMPRESSED_PREFIX + base64.b64encode(data).decode('ascii')
+
+
+def decompress_output(stored):
+    """ Inverse of :func:`compress_output` """
+    if stored is None or not stored.startswith(COMPRESSED_PREFIX):
+        return stored
+    data = base64.b64decode(stored[len(COMPRESSED_PREFIX):])
+    return zlib.decompress(data).decode('utf-8')
@@ -0,0 +1,163 @@
+"""
+Profiling individual check runs
+
+A profiled run records the functions with the most cumulative time and
+statistics about the queries it ran. The raw profile is stored in the pstats
+format, so it can be downloaded from ``palantir/check/profile/get`` and opened
+with any standard tool (``python -m pstats``, snakeviz, etc).
+
+"""
+import cProfile
+import json
+import marshal
+import pstats
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from .models import CheckProfile
+
+
+# Number of functions and queries to include in the summary
+SUMMARY_SIZE = 25
+
+_QUERIES = threading.local()
+_TRACKED_ENGINES = set()
+
+
+def should_profile(check, settings, requested=False):
+    """
+    Decide whether to profile a run of a check
+
+    Parameters
+    ----------
+    check : :class:`~steward_palantir.check.Check` or None
+    settings : dict
+        Uses ``palantir.profile.sample``. If set to N, 1 in N runs are
+        profiled.
+    requested : bool, optional
+        True if the caller asked for a profile
+
+    """
+    if requested or (check is not None and check.meta.get('profile')):
+        return True
+    sample = int(settings.get('palantir.profile.sample', 0))
+    return sample > 0 and random.random() * sample < 1
+
+
+class QueryStats(object):
+    """ Count and time the queries run on one thread """
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = defaultdict(lambda: [0, 0.0])
+
+    def add(self, statement, seconds):
+        """ Record one query """
+        self.count += 1
+        self.seconds += seconds
+        stats = self.statements[statement]
+        stats[0] += 1
+        stats[1] += seconds
+
+    def __json__(self, request=None):
+        top = sorted(self.statements.iteritems(), key=lambda x: x[1][1],
+                     reverse=True)[:SUMMARY_SIZE]
+        return {
+            'count': self.count,
+            'seconds': self.seconds,
+            'statements': [{'statement': statement, 'count': count,
+                            'seconds': seconds}
+                           for statement, (count, seconds) in top],
+        }
+
+
+def _track_queries(db):
+    """ Listen for the queries run on a session's engine """
+    engine = db.get_bind()
+    if id(engine) in _TRACKED_ENGINES:
+        return
+    _TRACKED_ENGINES.add(id(engine))
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_execute(*_):
+        """ Note when the query started """
+        _QUERIES.start = time.time()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_execute(conn, cursor, statement, *_):
+        """ Record the query if this thread is being profiled """
+        stats = getattr(_QUERIES, 'stats', None)
+        if stats is not None:
+            stats.add(statement, time.time() - _QUERIES.start)
+
+
+def top_functions(stats):
+    """ Get the functions with the most cumulative time from pstats data """
+    top = sorted(stats.iteritems(), key=lambda x: x[1][3],
+                 reverse=True)[:SUMMARY_SIZE]
+    return [{'function': pstats.func_std_string(func), 'calls': nc,
+             'total': tt, 'cumulative': ct}
+            for func, (_, nc, tt, ct, _) in top]
+
+
+@contextmanager
+def profile_run(task, check_name, requested=False):
+    """
+    Profile a run of a check if it was requested or sampled
+
+    The profile is added to the session when the block finishes without an
+    error. Only the newest ``palantir.profile.max_entries`` (default 20)
+    profiles of each check are kept.
+
+    Parameters
+    ----------
+    task : object
+        The current Celery task
+    check_name : str
+    requested : bool, optional
+        Always profile this run
+
+    """
+    settings = task.config.settings
+    check = task.config.registry.palantir_checks.get(check_name)
+    if not should_profile(check, settings, requested):
+        yield
+        return
+
+    _track_queries(task.db)
+    _QUERIES.stats = queries = QueryStats()
+    profiler = cProfile.Profile()
+    start = time.time()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _QUERIES.stats = None
+    duration = time.time() - start
+
+    stats = pstats.Stats(profiler).stats
+    summary = {
+        'functions': top_functions(stats),
+        'queries': queries.__json__(),
+    }
+    task.db.add(CheckProfile(check_name, duration, json.dumps(summary),
+                             marshal.dumps(stats)))
+    _trim_profiles(task.db, check_name,
+                   int(settings.get('palantir.profile.max_entries', 20)))
+
+
+def _trim_profiles(db, check_name, max_entries):
+    """ Delete all but the newest profiles of a check """
+    db.flush()
+    old = db.query(CheckProfile.id).filter_by(check=check_name)\
+        .order_by(CheckProfile.id.desc()).offset(max_entries)
+    ids = [profile_id for (profile_id,) in old]
+    if ids:
+        db.query(CheckProfile).filter(CheckProfile.id.in_(ids))\
+            .delete(synchronize_session=False)
@@ -0,0 +1,222 @@
+""" Scheduling of palantir checks """
+import math
+import zlib
+from collections import namedtuple
+from datetime import timedelta
+
+
+def tick_seconds(settings):
+    """ Get the number of seconds between scheduler ticks """
+    return float(settings.get('palantir.tick', 5))
+
+
+def max_catchup(settings):
+    """
+    Get how far back in seconds the scheduler will catch up on missed runs
+
+    Uses ``palantir.max_catchup`` (default 86400)
+
+    """
+    return float(settings.get('palantir.max_catchup', 86400))
+
+
+def window_start(last_tick, now, settings):
+    """
+    Get the start of the window to look for due checks in
+
+    The window reaches back to the previous tick, so a tick that was delayed
+    still runs every check that came due in the meantime (once, no matter how
+    many runs it missed). Runs older than :func:`max_catchup` are dropped.
+
+    Parameters
+    ----------
+    last_tick : float
+        Unix timestamp of the end of the previous window
+    now : float
+    settings : dict
+
+    """
+    return max(last_tick, now - max_catchup(settings))
+
+
+def late_checks(checks, start, on_time_start, end, schedules=None):
+    """
+    Get the names of the checks that are only due because they missed a run
+
+    These are the checks that are due in the window (start, end] but not in
+    the window (on_time_start, end]. Call this before :func:`due_checks`,
+    which updates the schedules of adaptive checks.
+
+    Parameters
+    ----------
+    checks : dict
+        Map of check names to :class:`~steward_palantir.check.Check`s
+    start : float
+        Unix timestamp of the start of the scheduling window
+    on_time_start : float
+        Unix timestamp after which a run is considered on time
+    end : float
+    schedules : dict, optional
+        See :func:`due_checks`
+
+    """
+    if on_time_start <= start:
+        return []
+    schedules = schedules or {}
+    late = []
+    for name, check in checks.iteritems():
+        schedule = schedules.get(name)
+        if schedule is not None:
+            if start < schedule.next_run <= on_time_start:
+                late.append(name)
+        else:
+            interval = check_interval(check)
+            if is_due(name, interval, start, on_time_start) and \
+                    not is_due(name, interval, on_time_start, end):
+                late.append(name)
+    return late
+
+
+AdaptiveSchedule = namedtuple('AdaptiveSchedule',
+                              ['min_interval', 'max_interval', 'stable_runs'])
+
+
+def check_interval(check):
+    """ Get the number of seconds between runs of a check """
+    schedule = dict(check.schedule)
+    schedule.pop('adaptive', None)
+    return timedelta(**schedule).total_seconds()
+
+
+def adaptive_schedule(check):
+    """
+    Get the adaptive schedule settings for a check
+
+    A check opts in by adding an ``adaptive`` dict to its ``schedule``. It may
+    contain ``min`` and ``max`` (keyword arguments to
+    :class:`datetime.timedelta`, default to the base interval) and
+    ``stable_runs`` (default 5).
+
+    Returns
+    -------
+    schedule : :class:`.AdaptiveSchedule` or None
+        None if the check does not use an adaptive schedule
+
+    """
+    adaptive = check.schedule.get('adaptive')
+    if not adaptive:
+        return None
+    interval = check_interval(check)
+    min_interval = max_interval = interval
+    if adaptive.get('min'):
+        min_interval = timedelta(**adaptive['min']).total_seconds()
+    if adaptive.get('max'):
+        max_interval = timedelta(**adaptive['max']).total_seconds()
+    return AdaptiveSchedule(min_interval, max_interval,
+                            int(adaptive.get('stable_runs', 5)))
+
+
+def adapt_interval(adaptive, interval, stable_runs, failing):
+    """
+    Calculate the next interval of an adaptive check
+
+    A failing check halves its interval down to the minimum. A check that has
+    succeeded ``stable_runs`` times in a row doubles its interval up to the
+    maximum.
+
+    Parameters
+    ----------
+    adaptive : :class:`.AdaptiveSchedule`
+    interval : float
+        The current interval in seconds
+    stable_runs : int
+        The number of successful runs since the interval last changed
+    failing : bool
+        True if the last run had any non-zero results
+
+    Returns
+    -------
+    interval : float
+    stable_runs : int
+
+    """
+    if failing:
+        return max(adaptive.min_interval, interval / 2.0), 0
+    stable_runs += 1
+    if stable_runs >= adaptive.stable_runs:
+        return min(adaptive.max_interval, interval * 2.0), 0
+    return interval, stable_runs
+
+
+def check_phase(name, interval):
+    """
+    Get the offset of a check within its interval
+
+    The offset is derived from a hash of the name, so checks with the same
+    interval are spread out evenly and each check always runs at the same
+    point in its interval.
+
+    """
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return (zlib.crc32(name) & 0xffffffff) / float(1 << 32) * interval
+
+
+def is_due(name, interval, start, end):
+    """
+    Check if a check should run in a time window
+
+    Parameters
+    ----------
+    name : str
+        The name of the check
+    interval : float
+        The number of seconds between runs of the check
+    start : float
+        Unix timestamp of the start of the window (exclusive)
+    end : float
+        Unix timestamp of the end of the window (inclusive)
+
+    """
+    if interval <= 0:
+        return False
+    phase = check_phase(name, interval)
+    return (math.floor((end - phase) / interval) >
+            math.floor((start - phase) / interval))
+
+
+def due_checks(checks, start, end, schedules=None):
+    """
+    Get the names of all checks that should run in a time window
+
+    Parameters
+    ----------
+    checks : dict
+        Map of check names to :class:`~steward_palantir.check.Check`s
+    start : float
+        Unix timestamp of the start of the window (exclusive)
+    end : float
+        Unix timestamp of the end of the window (inclusive)
+    schedules : dict, optional
+        Map of check names to the
+        :class:`~steward_palantir.models.CheckSchedule` of adaptive checks.
+        The ``next_run`` of each adaptive check that is due will be pushed
+        back by its interval. Adaptive checks whose ``next_run`` is before
+        ``start`` missed their run by longer than the scheduler catches up
+        (see :func:`window_start`), and are rescheduled without running.
+
+    """
+    schedules = schedules or {}
+    due = []
+    for name, check in checks.iteritems():
+        schedule = schedules.get(name)
+        if schedule is not None:
+            if schedule.next_run <= start:
+                schedule.next_run = end + check_phase(name,
+                                                      schedule.interval)
+            elif schedule.next_run <= end:
+                schedule.next_run = end + schedule.interval
+                due.append(name)
+        elif is_due(name, check_interval(check), start, end):
+            due.append(name)
+    return due
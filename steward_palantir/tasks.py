@@ -1,16 +1,65 @@
 """ Palantir tasks """
 import itertools
+import logging
+import time
 from datetime import datetime
 
 import copy
+import json
+import transaction
 from collections import defaultdict
+from contextlib import contextmanager
+from celery import chord, group
+from pyramid.settings import asbool
+from sqlalchemy.orm.attributes import set_committed_value
 from steward_salt.tasks import salt_match, salt, salt_key
 from steward_tasks.tasks import pub
 
-from .models import CheckDisabled, MinionDisabled, CheckResult, Alert
+from .alerting import (async_alerts, alert_queue, get_breaker, CircuitOpen,
+                       CheckGroup, coalesce_window, handler_key)
+from .history import history_enabled, append_history, prune_history
+from .metrics import METRICS, track_db_time, db_seconds
+from .models import (MinionDisabled, CheckResult, CheckHistory, Alert,
+                     SchedulerState, CheckSchedule, PendingAlert, ShardedRun,
+                     output_fingerprint, BULK_BATCH_SIZE)
+from .output import output_limit
+from .profiling import profile_run
+from .scheduler import (due_checks, tick_seconds, check_interval,
+                        adaptive_schedule, adapt_interval, window_start,
+                        late_checks)
 from steward_tasks import celery, StewardTask, lock
 
 
+LOG = logging.getLogger(__name__)
+
+
+def _distinct(task, column):
+    """ Get the set of distinct values of a column """
+    return set(itertools.chain.from_iterable(
+        task.db.query(column).group_by(column).all()))
+
+
+def _delete_batched(task, model, criterion):
+    """
+    Delete rows in batches, committing after each batch
+
+    Returns
+    -------
+    deleted : int
+        The number of rows deleted
+
+    """
+    deleted = 0
+    while True:
+        ids = [row_id for (row_id,) in task.db.query(model.id)
+               .filter(criterion).limit(BULK_BATCH_SIZE)]
+        if not ids:
+            return deleted
+        deleted += task.db.query(model).filter(model.id.in_(ids))\
+            .delete(synchronize_session=False)
+        transaction.commit()
+
+
 @celery.task(base=StewardTask)
 def prune():
     """
@@ -18,142 +67,887 @@ def prune():
 
     Remove check results from checks that no longer exist
 
+    Downsample and trim the check history
+
+    Rows are deleted in small batches, each in its own transaction, so the
+    tables are never locked for long.
+
+    Returns
+    -------
+    data : dict
+        The minions that were 'removed' and 'added', the number of
+        'history_pruned' entries per check, and the number of 'rows' deleted
+        and the 'seconds' spent per table in 'tables'.
+
     """
     task = prune
-    check_names = task.config.registry.palantir_checks
-    task.db.query(CheckResult)\
-        .filter(CheckResult.check.notin_(check_names))\
-        .delete(synchronize_session=False)
-    task.db.query(Alert)\
-        .filter(Alert.check.notin_(check_names))\
-        .delete(synchronize_session=False)
+    tables = {}
+
+    def delete(model, column, names):
+        """ Delete all rows where column is in names """
+        start = time.time()
+        deleted = 0
+        names = list(names)
+        for i in xrange(0, len(names), BULK_BATCH_SIZE):
+            criterion = column.in_(names[i:i + BULK_BATCH_SIZE])
+            if model in (MinionDisabled, CheckSchedule, ShardedRun):
+                # These tables are small and keyed by name
+                rows = task.db.query(model).filter(criterion)\
+                    .delete(synchronize_session=False)
+                if rows and model is MinionDisabled:
+                    task.config.registry.palantir_disabled\
+                        .invalidate(task.db)
+                transaction.commit()
+                deleted += rows
+            else:
+                deleted += _delete_batched(task, model, criterion)
+        stats = tables.setdefault(model.__tablename__,
+                                  {'rows': 0, 'seconds': 0.0})
+        stats['rows'] += deleted
+        stats['seconds'] += time.time() - start
+
+    check_names = set(task.config.registry.palantir_checks)
+    for model in (CheckResult, Alert, CheckHistory, CheckSchedule,
+                  ShardedRun):
+        delete(model, model.check, _distinct(task, model.check) - check_names)
 
     minion_list = salt_key('list_keys')['minions']
     minions = set(minion_list)
-    old_minions = set(itertools.chain.from_iterable(
-        task.db.query(CheckResult.minion)
-        .group_by(CheckResult.minion).all()))
+    old_minions = _distinct(task, CheckResult.minion)
     removed = old_minions - minions
     added = minions - old_minions
     if removed:
-        task.db.query(MinionDisabled).filter(MinionDisabled.name.in_(removed))\
-            .delete(synchronize_session=False)
-        task.db.query(CheckResult).filter(CheckResult.minion.in_(removed))\
-            .delete(synchronize_session=False)
-        task.db.query(Alert).filter(Alert.minion.in_(removed))\
-            .delete(synchronize_session=False)
+        delete(MinionDisabled, MinionDisabled.name, removed)
+        for model in (CheckResult, Alert, CheckHistory):
+            delete(model, model.minion, removed)
+    history = prune_history(task.db, task.config.settings, list(check_names))
+    for name, stats in tables.iteritems():
+        LOG.info("Pruned %d rows from %s in %.2fs", stats['rows'], name,
+                 stats['seconds'])
     return {
         'removed': list(removed),
         'added': list(added),
+        'history_pruned': history,
+        'tables': tables,
+    }
+
+
+def _load_results(task, check_name, minions=None):
+    """
+    Bulk-load the existing results for a check
+
+    Parameters
+    ----------
+    task : object
+        The current Celery task
+    check_name : str
+    minions : list, optional
+        If provided, only load the results for these minions
+
+    Returns
+    -------
+    results : dict
+        Map of minion name to the existing
+        :class:`~steward_palantir.models.CheckResult` for this check
+
+    """
+    query = task.db.query(CheckResult).filter_by(check=check_name)
+    if minions is not None:
+        query = query.filter(CheckResult.minion.in_(minions))
+    return dict((result.minion, result) for result in query)
+
+
+def _should_run(minion, disabled_minions, existing_results):
+    """ Should the check be run on this minion """
+    if minion in disabled_minions:
+        return False
+    result = existing_results.get(minion)
+    if result is not None and not result.enabled:
+        return False
+    return True
+
+
+def _update_result(task, check, minion, result, existing_results,
+                   new_results):
+    """
+    Store a minion's response to a check and run the check handlers on it
+
+    Parameters
+    ----------
+    task : object
+        The current Celery task
+    check : :class:`~steward_palantir.check.Check`
+    minion : str
+    result : dict
+        The 'cmd.run_all' response from salt
+    existing_results : dict
+        Map of minion name to the existing
+        :class:`~steward_palantir.models.CheckResult` for this check
+    new_results : dict
+        Map of minion name to the :class:`~steward_palantir.models.CheckResult`
+        rows created for this run by :func:`_create_results`
+
+    Returns
+    -------
+    check_result : :class:`~steward_palantir.models.CheckResult`
+    changed : bool
+        True if the alert status of the result needs to change
+    bump_only : bool
+        True if the only changes to the stored result are a new ``last_run``
+        and an incremented ``count``. Those changes are hidden from the session
+        and must be written by :func:`_bump_results`.
+
+    """
+    fingerprint = output_fingerprint(result['stdout'], result['stderr'])
+    limit = output_limit(check, task.config.settings)
+    check_result = existing_results.get(minion)
+    if check_result is None:
+        old_result = None
+        check_result = new_results.get(minion)
+        if check_result is None:
+            check_result = CheckResult(minion, check.name)
+            task.db.add(check_result)
+            new_results[minion] = check_result
+        check_result.old_result = CheckResult(minion, check.name)
+    else:
+        old_result = check_result.old_result = copy.copy(check_result)
+        if check_result.retcode == result['retcode']:
+            check_result.count += 1
+        else:
+            check_result.count = 1
+    # Only the stored output is truncated, the handlers see all of it. Don't
+    # rewrite the output columns if the output hasn't changed.
+    store = check_result.fingerprint != fingerprint
+    check_result.set_output(result['stdout'], result['stderr'], limit, store)
+    check_result.fingerprint = fingerprint
+    check_result.retcode = result['retcode']
+    check_result.last_run = datetime.now()
+
+    handler_result = check.run_handler(task, check_result)
+
+    changed = (check_result.alert != check_result.normalized_retcode and
+               handler_result is not True)
+
+    bump_only = (old_result is not None and
+                 old_result.fingerprint == check_result.fingerprint and
+                 old_result.retcode == check_result.retcode and
+                 old_result.count + 1 == check_result.count)
+    if bump_only:
+        set_committed_value(check_result, 'count', check_result.count)
+        set_committed_value(check_result, 'last_run', check_result.last_run)
+    return check_result, changed, bump_only
+
+
+def _create_results(task, check_name, minions):
+    """
+    Bulk-create the results for minions that have never run a check
+
+    Returns
+    -------
+    results : dict
+        Map of minion name to the new
+        :class:`~steward_palantir.models.CheckResult`
+
+    """
+    CheckResult.bulk_create(task.db, [(minion, check_name) for minion in
+                                      minions])
+    results = {}
+    for i in xrange(0, len(minions), BULK_BATCH_SIZE):
+        query = task.db.query(CheckResult).filter_by(check=check_name)\
+            .filter(CheckResult.minion.in_(minions[i:i + BULK_BATCH_SIZE]))
+        for result in query:
+            results[result.minion] = result
+    return results
+
+
+def _bump_results(task, results):
+    """
+    Increment the count and set the last_run of unchanged results in bulk
+
+    Parameters
+    ----------
+    task : object
+        The current Celery task
+    results : list
+        The :class:`~steward_palantir.models.CheckResult`s that were marked
+        ``bump_only`` by :func:`_update_result`
+
+    """
+    now = datetime.now()
+    for i in xrange(0, len(results), BULK_BATCH_SIZE):
+        ids = [result.id for result in results[i:i + BULK_BATCH_SIZE]]
+        task.db.query(CheckResult).filter(CheckResult.id.in_(ids))\
+            .update({CheckResult.count: CheckResult.count + 1,
+                     CheckResult.last_run: now},
+                    synchronize_session=False)
+    for result in results:
+        set_committed_value(result, 'last_run', now)
+
+
+def _salt_returns(task, check, minions):
+    """
+    Run the check command on minions with salt
+
+    If ``palantir.stream_results`` is set, the returns are yielded as the
+    minions respond instead of waiting for all of them.
+
+    Returns
+    -------
+    returns : iterable
+        Iterable of (minion, result) tuples, where result is the
+        'cmd.run_all' response
+
+    """
+    start = time.time()
+    target = ','.join(minions)
+    if not _stream_results(task):
+        returns = salt(target, 'cmd.run_all', kwarg=check.command,
+                       expr_form='list', timeout=check.timeout).iteritems()
+    else:
+        returns = _iter_salt(target, check)
+    return _timed_returns(check, returns, time.time() - start)
+
+
+def _timed_returns(check, returns, waited):
+    """ Record the time spent waiting for salt while iterating the returns """
+    returns = iter(returns)
+    while True:
+        start = time.time()
+        try:
+            item = next(returns)
+        except StopIteration:
+            break
+        finally:
+            waited += time.time() - start
+        yield item
+    METRICS.observe('palantir_salt_seconds', waited, check=check.name)
+
+
+def _stream_results(task):
+    """ Should salt returns be processed as the minions respond """
+    return asbool(task.config.settings.get('palantir.stream_results', False))
+
+
+def _iter_salt(target, check):
+    """ Generator for salt returns as each minion responds """
+    from salt.client import LocalClient  # pylint: disable=F0401
+    client = LocalClient()
+    for response in client.cmd_iter(target, 'cmd.run_all',
+                                    kwarg=check.command, expr_form='list',
+                                    timeout=check.timeout):
+        for minion, data in response.iteritems():
+            yield minion, data.get('ret', data)
+
+
+def _process_returns(task, check, minions, returns, disabled_minions,
+                     existing_results, new_results, started, flush=False):
+    """
+    Store the salt returns for all minions and run the check handlers
+
+    Any of the ``minions`` that did not respond get a 'salt timeout' result at
+    the end. If ``flush`` is True, each result is flushed to the database as
+    soon as it is processed. If the check history is enabled, an entry is
+    appended for each result, with a duration measured from ``started`` to
+    when the result was processed.
+
+    Returns
+    -------
+    check_results : dict
+        Map of minion name to :class:`~steward_palantir.models.CheckResult`
+    changed_results : dict
+        Map of normalized retcode to a list of the
+        :class:`~steward_palantir.models.CheckResult`s whose alert status
+        needs to change
+
+    """
+    check_results = {}
+    changed_results = defaultdict(list)
+    bump_results = []
+    history = []
+    record_history = history_enabled(task.config.settings)
+
+    def process(minion, result):
+        """ Process a single minion's result """
+        check_result, changed, bump_only = _update_result(
+            task, check, minion, result, existing_results, new_results)
+        if record_history:
+            history.append({
+                'minion': minion,
+                'check': check.name,
+                'retcode': check_result.retcode,
+                'fingerprint': check_result.fingerprint,
+                'created': check_result.last_run,
+                'duration': (check_result.last_run - started).total_seconds(),
+            })
+        if changed:
+            changed_results[
+                check_result.normalized_retcode].append(check_result)
+        if bump_only:
+            bump_results.append(check_result)
+        check_results[minion] = check_result
+
+    for minion, result in returns:
+        if minion in check_results or \
+                not _should_run(minion, disabled_minions, existing_results):
+            continue
+        process(minion, result)
+        if flush:
+            task.db.flush()
+    responded = len(check_results)
+
+    # If no response, replace it with a 'salt timeout' message
+    for minion in minions:
+        if minion in check_results or \
+                not _should_run(minion, disabled_minions, existing_results):
+            continue
+        process(minion, {
+            'retcode': 1000,
+            'stdout': '',
+            'stderr': '<< SALT TIMED OUT >>',
+        })
+    METRICS.inc('palantir_minions_total', len(minions), check=check.name,
+                state='matched')
+    METRICS.inc('palantir_minions_total', responded, check=check.name,
+                state='responded')
+    METRICS.inc('palantir_minions_total', len(check_results) - responded,
+                check=check.name, state='timed_out')
+    _bump_results(task, bump_results)
+    append_history(task.db, history)
+    return check_results, changed_results
+
+
+def _adapt_schedule(task, check, failing):
+    """
+    Update the interval of a check with an adaptive schedule after a run
+
+    Parameters
+    ----------
+    task : object
+        The current Celery task
+    check : :class:`~steward_palantir.check.Check`
+    failing : bool
+        True if any result of the run had a non-zero retcode
+
+    """
+    adaptive = adaptive_schedule(check)
+    if adaptive is None:
+        return
+    schedule = task.db.query(CheckSchedule).filter_by(check=check.name)\
+        .first()
+    if schedule is None:
+        schedule = CheckSchedule(check.name, check_interval(check))
+        task.db.add(schedule)
+    schedule.interval, schedule.stable_runs = adapt_interval(
+        adaptive, schedule.interval, schedule.stable_runs, failing)
+    schedule.next_run = time.time() + schedule.interval
+
+
+def _alert_event(result):
+    """ Compact description of a check result for the event stream """
+    return {
+        'minion': result.minion,
+        'check': result.check,
+        'retcode': result.retcode,
+        'fingerprint': result.fingerprint,
     }
 
 
+def _handle_changed(task, check, changed_results):
+    """
+    Run all the event handlers and update the alert status
+
+    Publishes at most one 'palantir/alert/raised' and one
+    'palantir/alert/resolved' event for the whole check run. The events only
+    identify the results. Fetch the output from ``palantir/minion/check/get``
+    if you need it.
+
+    """
+    events = {'raised': [], 'resolved': []}
+    for normalized_retcode, results in changed_results.iteritems():
+        handle_results(task, check, normalized_retcode, results)
+        key = 'resolved' if normalized_retcode == 0 else 'raised'
+        for result in results:
+            result.alert = normalized_retcode
+            events[key].append(_alert_event(result))
+    for key in ('raised', 'resolved'):
+        if events[key]:
+            pub('palantir/alert/' + key, data={'results': events[key]})
+
+
+@contextmanager
+def _instrumented(task, check_name):
+    """
+    Record the duration and database time of a check run
+
+    The collected metrics are flushed to the database afterwards.
+
+    """
+    track_db_time(task.db)
+    start = time.time()
+    db_start = db_seconds()
+    yield
+    METRICS.observe('palantir_check_run_seconds', time.time() - start,
+                    check=check_name)
+    METRICS.observe('palantir_db_seconds', db_seconds() - db_start,
+                    check=check_name)
+    METRICS.flush(task.db, task.config.settings)
+
+
+def _start_sharded_run(task, check_name):
+    """
+    Mark the start of a sharded run of a check
+
+    The mark is removed by :func:`merge_check_shards`. It is ignored after
+    ``palantir.shard_run_timeout`` seconds (default 600) in case a shard
+    failed and the merge never ran.
+
+    Returns
+    -------
+    started : bool
+        False if the previous sharded run of the check hasn't finished
+
+    """
+    now = time.time()
+    timeout = float(task.config.settings.get('palantir.shard_run_timeout',
+                                             600))
+    run = task.db.query(ShardedRun).filter_by(check=check_name).first()
+    if run is not None and run.started > now - timeout:
+        return False
+    if run is None:
+        task.db.add(ShardedRun(check_name, now))
+    else:
+        run.started = now
+    # Commit while holding the check lock so the next run will see it
+    transaction.commit()
+    return True
+
+
 @celery.task(base=StewardTask)
-def run_check(check_name):
-    """ Run a palantir check """
-    with lock.inline("palantir_check_%s" % check_name, expires=120, timeout=120):
+def run_check(check_name, profile=False):
+    """
+    Run a palantir check
+
+    If ``palantir.shard_size`` is set and the check matches more minions than
+    that, the minions are split into shards that are each run as a separate
+    :func:`run_check_shard` task. The alert handlers are run once for all the
+    shards by :func:`merge_check_shards`.
+
+    Parameters
+    ----------
+    check_name : str
+    profile : bool, optional
+        Profile this run (see :mod:`steward_palantir.profiling`). Runs are
+        also profiled if the check has ``profile`` set in its meta, or if they
+        are sampled with ``palantir.profile.sample``.
+
+    """
+    with lock.inline("palantir_check_%s" % check_name, expires=120,
+                     timeout=120), _instrumented(run_check, check_name), \
+            profile_run(run_check, check_name, profile):
         task = run_check
+        task.config.registry.palantir_check_loader.reload(task.config.registry)
 
-        if task.db.query(CheckDisabled).filter_by(name=check_name).first():
+        disabled = task.config.registry.palantir_disabled.get(task.db)
+        if check_name in disabled.checks:
             return 'check disabled'
+        disabled_minions = disabled.minions
+        existing_results = _load_results(task, check_name)
 
         check = task.config.registry.palantir_checks[check_name]
 
-        def do_minion_check(minion, check):
-            """ Should this check be run on this minion """
-            if task.db.query(MinionDisabled).filter_by(name=minion).first():
-                return False
-            result = task.db.query(CheckResult).filter_by(minion=minion,
-                                                          check=check).first()
-            if result is not None and not result.enabled:
-                return False
-            return True
-
-        expected_minions = salt_match(check.target, check.expr_form)
-        i = 0
-        while i < len(expected_minions):
-            minion = expected_minions[i]
-            if not do_minion_check(minion, check_name):
-                del expected_minions[i]
-                continue
-            i += 1
-        target = ','.join(expected_minions)
-        expr_form = 'list'
+        expected_minions = [minion for minion in
+                            salt_match(check.target, check.expr_form)
+                            if _should_run(minion, disabled_minions,
+                                           existing_results)]
         if len(expected_minions) == 0:
             return 'No minions matched'
 
-        response = salt(target, 'cmd.run_all', kwarg=check.command,
-                                expr_form=expr_form, timeout=check.timeout)
+        shard_size = int(task.config.settings.get('palantir.shard_size', 0))
+        if shard_size and len(expected_minions) > shard_size:
+            if not _start_sharded_run(task, check_name):
+                return 'Previous run still in progress'
+            shards = [expected_minions[i:i + shard_size] for i in
+                      xrange(0, len(expected_minions), shard_size)]
+            chord(run_check_shard.s(check_name, i, shard) for i, shard in
+                  enumerate(shards))(merge_check_shards.s(check_name))
+            return 'Running on %d minions in %d shards' % \
+                (len(expected_minions), len(shards))
 
-        combined_minions = set(expected_minions).union(set(response.keys()))
+        new_results = _create_results(
+            task, check_name, [minion for minion in expected_minions
+                               if minion not in existing_results])
 
-        # Process results for each minion
-        check_results = {}
-        changed_results = defaultdict(list)
-        for minion in combined_minions:
-            if not do_minion_check(minion, check_name):
-                continue
-            # Get the response. If no response, replace it with a 'salt timeout'
-            # message
-            result = response.get(minion, {
-                'retcode': 1000,
-                'stdout': '',
-                'stderr': '<< SALT TIMED OUT >>',
-            })
+        started = datetime.now()
+        returns = _salt_returns(task, check, expected_minions)
 
-            check_result = task.db.query(CheckResult)\
-                .filter_by(check=check_name, minion=minion).first()
-            if check_result is None:
-                check_result = CheckResult(minion, check.name)
-                check_result.old_result = CheckResult(minion, check.name)
-                task.db.add(check_result)
-            else:
-                check_result.old_result = copy.copy(check_result)
-                if check_result.retcode == result['retcode']:
-                    check_result.count += 1
-                else:
-                    check_result.count = 1
-            check_result.stdout = result['stdout']
-            check_result.stderr = result['stderr']
-            check_result.retcode = result['retcode']
-            check_result.last_run = datetime.now()
-
-            handler_result = check.run_handler(task, check_result)
-
-            if check_result.alert != check_result.normalized_retcode and \
-                    handler_result is not True:
-                changed_results[
-                    check_result.normalized_retcode].append(check_result)
-
-            check_results[minion] = check_result
-
-        # Run all the event handlers
-        for normalized_retcode, results in changed_results.iteritems():
-            handle_results(task, check, normalized_retcode, results)
-            for result in results:
-                result.alert = result.normalized_retcode
+        check_results, changed_results = _process_returns(
+            task, check, expected_minions, returns, disabled_minions,
+            existing_results, new_results, started, _stream_results(task))
+
+        _handle_changed(task, check, changed_results)
+        _adapt_schedule(task, check, any(result.retcode != 0 for result in
+                                         check_results.itervalues()))
 
         return check_results
 
 
+@celery.task(base=StewardTask)
+def run_check_shard(check_name, index, minions):
+    """
+    Run a palantir check on one shard of its minions
+
+    Parameters
+    ----------
+    check_name : str
+    index : int
+        The index of the shard
+    minions : list
+        The minions in the shard
+
+    Returns
+    -------
+    changed : dict
+        Map of normalized retcode to the list of minions whose alert status
+        needs to change. The alert handlers are not run on the shard.
+
+    """
+    with lock.inline("palantir_check_%s_%d" % (check_name, index),
+                     expires=120, timeout=120), \
+            _instrumented(run_check_shard, check_name):
+        task = run_check_shard
+        check = task.config.registry.palantir_checks[check_name]
+        disabled_minions = task.config.registry.palantir_disabled\
+            .get(task.db).minions
+        existing_results = _load_results(task, check_name, minions)
+
+        new_results = _create_results(
+            task, check_name, [minion for minion in minions
+                               if minion not in existing_results])
+
+        started = datetime.now()
+        returns = _salt_returns(task, check, minions)
+
+        _, changed_results = _process_returns(
+            task, check, minions, returns, disabled_minions,
+            existing_results, new_results, started, _stream_results(task))
+
+        return dict((normalized_retcode, [result.minion for result in results])
+                    for normalized_retcode, results in
+                    changed_results.iteritems())
+
+
+@celery.task(base=StewardTask)
+def merge_check_shards(shard_changes, check_name):
+    """
+    Run the alert handlers once for all shards of a check run
+
+    Parameters
+    ----------
+    shard_changes : list
+        The return values of each :func:`run_check_shard` task
+    check_name : str
+
+    """
+    task = merge_check_shards
+    task.db.query(ShardedRun).filter_by(check=check_name)\
+        .delete(synchronize_session=False)
+    check = task.config.registry.palantir_checks[check_name]
+    failing = task.db.query(CheckResult.id)\
+        .filter_by(check=check_name, enabled=True)\
+        .filter(CheckResult.retcode != 0).first() is not None
+    _adapt_schedule(task, check, failing)
+    changed_minions = {}
+    for changes in shard_changes:
+        for normalized_retcode, minions in changes.iteritems():
+            for minion in minions:
+                changed_minions[minion] = int(normalized_retcode)
+    if changed_minions:
+        changed_results = defaultdict(list)
+        results = task.db.query(CheckResult).filter_by(check=check_name)\
+            .filter(CheckResult.minion.in_(list(changed_minions)))
+        for result in results:
+            changed_results[changed_minions[result.minion]].append(result)
+
+        _handle_changed(task, check, changed_results)
+    METRICS.flush(task.db, task.config.settings)
+
+
 def handle_results(task, check, normalized_retcode, results):
     """ Run the check handlers and raise/resolve alerts if necessary """
     minions = [result.minion for result in results]
 
-    # delete any existing alerts
-    task.db.query(Alert).filter(Alert.minion.in_(minions)).\
-        filter_by(check=check.name).delete(synchronize_session=False)
+    with METRICS.timer('palantir_handle_results_seconds', check=check.name):
+        # delete any existing alerts
+        task.db.query(Alert).filter(Alert.minion.in_(minions)).\
+            filter_by(check=check.name).delete(synchronize_session=False)
 
-    result_data = {'results': [result.__json__() for result in results]}
-    if normalized_retcode == 0:
-        pub('palantir/alert/resolved', data=result_data)
-        check.run_alert_handlers(task, 'resolve', normalized_retcode, results)
+        if normalized_retcode == 0:
+            METRICS.inc('palantir_alerts_total', len(results),
+                        check=check.name, action='resolved')
+            run_alert_handlers(task, check, 'resolve', normalized_retcode,
+                               results)
 
-    else:
-        for result in results:
-            task.db.add(Alert.from_result(result))
-        pub('palantir/alert/raised', data=result_data)
-        check.run_alert_handlers(task, 'raise', normalized_retcode, results)
+        else:
+            for result in results:
+                task.db.add(Alert.from_result(result))
+            METRICS.inc('palantir_alerts_total', len(results),
+                        check=check.name, action='raised')
+            run_alert_handlers(task, check, 'raise', normalized_retcode,
+                               results)
+
+
+def run_alert_handlers(task, check, action, normalized_retcode, results,
+                       **kwargs):
+    """
+    Run the alert handlers for a check
+
+    If ``palantir.coalesce_window`` is set, the event is buffered and
+    delivered along with other events for the same handlers by
+    :func:`flush_alerts`. If ``palantir.async_alerts`` is set, the handlers
+    are run by a :func:`deliver_alert` task on the alert queue. Otherwise they
+    are run immediately.
+
+    """
+    with METRICS.timer('palantir_alert_handlers_seconds', check=check.name,
+                       action=action):
+        _run_alert_handlers(task, check, action, normalized_retcode, results,
+                            **kwargs)
+
+
+def _run_alert_handlers(task, check, action, normalized_retcode, results,
+                        **kwargs):
+    """ Implementation of :func:`run_alert_handlers` """
+    settings = task.config.settings
+    if coalesce_window(settings) > 0:
+        key = handler_key(check._get_handlers(task, action,
+                                              normalized_retcode, results,
+                                              **kwargs), **kwargs)
+        if key is not None:
+            task.db.add(PendingAlert(
+                check.name, action, normalized_retcode, key,
+                json.dumps([result.__json__() for result in results])))
+            return
+    if not async_alerts(settings):
+        check.run_alert_handlers(task, action, normalized_retcode, results,
+                                 **kwargs)
+        return
+    deliver_alert.apply_async(
+        args=[check.name, action, normalized_retcode,
+              [result.__json__() for result in results], kwargs],
+        queue=alert_queue(settings))
+
+
+def _find_check(checks, check_name):
+    """
+    Find the check(s) that a :func:`deliver_alert` is for
+
+    Parameters
+    ----------
+    checks : dict
+        Map of check names to :class:`~steward_palantir.check.Check`s
+    check_name : str or list
+        A list if the alert was coalesced from several checks
+
+    Returns
+    -------
+    check : :class:`~steward_palantir.check.Check` or None
+        The check to pass to the handlers. A
+        :class:`~steward_palantir.alerting.CheckGroup` if there were several.
+        None if none of the checks exist any more.
+    handler_check : :class:`~steward_palantir.check.Check` or None
+        The check to get the handlers from
+
+    """
+    if not isinstance(check_name, list):
+        check = checks[check_name]
+        return check, check
+    group_checks = [checks[name] for name in check_name if name in checks]
+    if not group_checks:
+        return None, None
+    if len(group_checks) == 1:
+        return group_checks[0], group_checks[0]
+    return CheckGroup(group_checks), group_checks[0]
+
+
+@celery.task(base=StewardTask)
+def flush_alerts():
+    """
+    Deliver all buffered alert events
+
+    Events with the same action, normalized retcode, and handler specs
+    (including recipients) are combined into a single :func:`deliver_alert`,
+    which retries the handlers if they fail. It is sent to the alert queue if
+    ``palantir.async_alerts`` is set.
+
+    Returns
+    -------
+    count : int
+        The number of deliveries that were dispatched
+
+    """
+    with lock.inline("palantir_flush_alerts", expires=120, timeout=120):
+        task = flush_alerts
+        checks = task.config.registry.palantir_checks
+        pending = task.db.query(PendingAlert).order_by(PendingAlert.id).all()
+        if not pending:
+            return 0
+        task.db.query(PendingAlert)\
+            .filter(PendingAlert.id <= pending[-1].id)\
+            .delete(synchronize_session=False)
+
+        groups = defaultdict(list)
+        for event in pending:
+            if event.check not in checks:
+                continue
+            groups[(event.action, event.normalized_retcode,
+                    event.handlers)].append(event)
+
+        settings = task.config.settings
+        for (action, normalized_retcode, key), events in \
+                groups.iteritems():
+            kwargs = json.loads(key)['kwargs']
+            kwargs['coalesced'] = True
+            check_names = []
+            results = []
+            for event in events:
+                if event.check not in check_names:
+                    check_names.append(event.check)
+                results.extend(json.loads(event.results))
+            LOG.debug("Delivering %d coalesced alert(s) for %s",
+                      len(results), ', '.join(check_names))
+            options = {}
+            if async_alerts(settings):
+                options['queue'] = alert_queue(settings)
+            deliver_alert.apply_async(
+                args=[check_names, action, normalized_retcode, results,
+                      kwargs], **options)
+        METRICS.flush(task.db, task.config.settings)
+        return len(groups)
+
+
+@celery.task(base=StewardTask)
+def deliver_alert(check_name, action, normalized_retcode, results,
+                  kwargs=None, start=0):
+    """
+    Run the alert handlers for a check
+
+    If a handler fails, this task is retried starting from that handler, so
+    the handlers before it are not run twice. Each handler has a circuit
+    breaker that fails fast after ``palantir.circuit_breaker.threshold``
+    failures in a row.
+
+    Parameters
+    ----------
+    check_name : str or list
+        A list of names if the alert was coalesced from several checks (see
+        :func:`flush_alerts`)
+    action : str {'raise', 'resolve'}
+    normalized_retcode : int
+    results : list
+        The json data of the :class:`~steward_palantir.models.CheckResult`s
+    kwargs : dict, optional
+        Other arguments to pass to the handlers
+    start : int, optional
+        The index of the first handler to run (default 0)
+
+    """
+    task = deliver_alert
+    settings = task.config.settings
+    check, handler_check = _find_check(task.config.registry.palantir_checks,
+                                       check_name)
+    if check is None:
+        return
+    kwargs = kwargs or {}
+    results = [CheckResult.from_json(result) for result in results]
+    handlers = handler_check.get_alert_handlers(task, action,
+                                                normalized_retcode, results,
+                                                **kwargs)
+    for i in xrange(start, len(handlers)):
+        handler = handlers[i]
+        breaker = get_breaker(handler.name, settings)
+        try:
+            breaker.check()
+            LOG.debug("Running handler '%s'", handler)
+            with METRICS.timer('palantir_handler_seconds',
+                               handler=handler.name, kind='alert'):
+                handler_result = handler.handle_alert(task, check,
+                                                      normalized_retcode,
+                                                      results, **kwargs)
+        except Exception as exc:
+            if isinstance(exc, CircuitOpen):
+                countdown = exc.retry_in
+            else:
+                LOG.exception("Error running handler '%s'", handler.name)
+                breaker.failure()
+                countdown = float(settings.get('palantir.alert_retry_delay',
+                                               30))
+            raise task.retry(
+                args=[check_name, action, normalized_retcode,
+                      [result.__json__() for result in results], kwargs, i],
+                exc=exc, countdown=countdown,
+                max_retries=int(settings.get('palantir.alert_retries', 3)))
+        breaker.success()
+        if handler_result is not None:
+            # If the handler returns a list of results, only apply
+            # successive handlers to that list
+            if len(handler_result) == 0:
+                break
+            results = handler_result
+    METRICS.flush(task.db, settings)
+
+
+@celery.task(base=StewardTask)
+def tick():
+    """
+    Dispatch all palantir checks that are due to run
+
+    This is run every ``palantir.tick`` seconds. Each check runs at a fixed
+    offset within its interval (see :mod:`steward_palantir.scheduler`), so
+    checks with the same schedule don't all run at the same time. A check
+    that missed any runs (e.g. because this task was delayed) is run once to
+    catch up, unless the runs are older than ``palantir.max_catchup``.
+
+    Returns
+    -------
+    checks : list
+        The names of the checks that were dispatched
+
+    """
+    with lock.inline("palantir_tick", expires=60, timeout=60):
+        task = tick
+        task.config.registry.palantir_check_loader.reload(task.config.registry)
+        now = time.time()
+        state = task.db.query(SchedulerState).filter_by(id=1).first()
+        if state is None:
+            state = SchedulerState(now - tick_seconds(task.config.settings))
+            task.db.add(state)
+        if state.last_tick >= now:
+            return []
+
+        checks = task.config.registry.palantir_checks
+        adaptive = [name for name, check in checks.iteritems()
+                    if adaptive_schedule(check) is not None]
+        schedules = {}
+        if adaptive:
+            for schedule in task.db.query(CheckSchedule)\
+                    .filter(CheckSchedule.check.in_(adaptive)):
+                schedules[schedule.check] = schedule
+        settings = task.config.settings
+        start = window_start(state.last_tick, now, settings)
+        if start > state.last_tick:
+            LOG.warning("Palantir scheduler was idle for %ds. Dropping runs "
+                        "that were due more than %ds ago.",
+                        now - state.last_tick, now - start)
+        late = late_checks(checks, start, now - 2 * tick_seconds(settings),
+                           now, schedules)
+        if late:
+            LOG.warning("Catching up on %d check(s) that missed their run: %s",
+                        len(late), ', '.join(sorted(late)))
+        due = due_checks(checks, start, now, schedules)
+        state.last_tick = now
+        if due:
+            group(run_check.s(name) for name in due).apply_async()
+        return due
 
 
 @celery.task(base=StewardTask)
@@ -163,22 +957,23 @@ def resolve_alerts(alerts, userid='unknown'):
     alert_checks = defaultdict(list)
     for alert in alerts:
         alert_checks[alert['check']].append(alert['minion'])
+    data = {'reason': 'Marked resolved by %s' % userid, 'alerts': []}
 
     for check_name, minions in alert_checks.iteritems():
         check = task.config.registry.palantir_checks[check_name]
         results = task.db.query(CheckResult).filter_by(check=check_name)\
             .filter(CheckResult.minion.in_(minions)).all()
-        check.run_alert_handlers(task, 'resolve', 0, results,
-                                 marked_resolved=True)
+        run_alert_handlers(task, check, 'resolve', 0, results,
+                           marked_resolved=True)
         for result in results:
             result.alert = 0
+            data['alerts'].append(_alert_event(result))
         task.db.query(Alert).filter_by(check=check_name)\
             .filter(Alert.minion.in_(minions))\
             .delete(synchronize_session=False)
-    data = {'reason': 'Marked resolved by %s' % userid,
-            'alerts': alerts,
-            }
-    pub('palantir/alert/resolved', data)
+    if data['alerts']:
+        pub('palantir/alert/resolved', data)
+    METRICS.flush(task.db, task.config.settings)
 
 
 @celery.task(base=StewardTask)
@@ -198,3 +993,4 @@ def toggle_minion(minions, enabled):
             task.db.query(MinionDisabled).filter_by(name=minion).delete()
         else:
             task.db.merge(MinionDisabled(minion))
+    task.config.registry.palantir_disabled.invalidate(task.db)
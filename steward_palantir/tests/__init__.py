@@ -0,0 +1 @@
+""" Tests for steward_palantir """
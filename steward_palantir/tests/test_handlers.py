@@ -0,0 +1,85 @@
+""" Tests for the check handlers """
+from unittest import TestCase
+
+from steward_palantir.handlers import RangeSpec
+
+
+class TestRangeSpec(TestCase):
+
+    """ Tests for RangeSpec """
+
+    def test_single_values(self):
+        """ Single numbers match only themselves """
+        spec = RangeSpec('0,2')
+        self.assertIn(0, spec)
+        self.assertIn(2, spec)
+        self.assertNotIn(1, spec)
+        self.assertNotIn(3, spec)
+
+    def test_int_spec(self):
+        """ The spec may be a plain int """
+        spec = RangeSpec(1)
+        self.assertIn(1, spec)
+        self.assertNotIn(0, spec)
+
+    def test_empty(self):
+        """ An empty spec matches nothing """
+        spec = RangeSpec('')
+        self.assertNotIn(0, spec)
+
+    def test_inclusive_range(self):
+        """ Ranges include both ends """
+        spec = RangeSpec('100-104')
+        self.assertNotIn(99, spec)
+        self.assertIn(100, spec)
+        self.assertIn(104, spec)
+        self.assertNotIn(105, spec)
+
+    def test_open_range(self):
+        """ A trailing '-' matches everything from that number up """
+        spec = RangeSpec('0,2,100-104,400-')
+        self.assertNotIn(399, spec)
+        self.assertIn(400, spec)
+        self.assertIn(10 ** 12, spec)
+
+    def test_open_range_not_last(self):
+        """ The open range may be listed before other ranges """
+        spec = RangeSpec('400-,2')
+        self.assertIn(2, spec)
+        self.assertNotIn(3, spec)
+        self.assertIn(500, spec)
+
+    def test_merge_overlapping(self):
+        """ Overlapping and contained ranges are merged """
+        spec = RangeSpec('1-5,3-8,4,20-30,25-26')
+        self.assertEqual(spec._starts, [1, 20])
+        self.assertEqual(spec._ends, [8, 30])
+        for value in (1, 5, 8, 20, 26, 30):
+            self.assertIn(value, spec)
+        for value in (0, 9, 19, 31):
+            self.assertNotIn(value, spec)
+
+    def test_merge_into_open_range(self):
+        """ Ranges that overlap the open range are merged into it """
+        spec = RangeSpec('500-600,400-,450')
+        self.assertEqual(spec._starts, [400])
+        self.assertEqual(spec._ends, [float('inf')])
+        self.assertIn(601, spec)
+
+    def test_unsorted(self):
+        """ The ranges may be listed in any order """
+        spec = RangeSpec('10-12,1,5-6')
+        self.assertEqual(spec._starts, [1, 5, 10])
+        self.assertIn(6, spec)
+        self.assertNotIn(7, spec)
+        self.assertIn(12, spec)
+
+    def test_below_all_ranges(self):
+        """ Values below the first range don't match """
+        spec = RangeSpec('5-10')
+        self.assertNotIn(-1, spec)
+        self.assertNotIn(4, spec)
+
+    def test_str(self):
+        """ str() returns the original spec """
+        self.assertEqual(str(RangeSpec('0,2,400-')), '0,2,400-')
@@ -0,0 +1,108 @@
+""" Tests for the check metrics """
+from unittest import TestCase
+
+from steward_palantir.metrics import Metrics, render, _split_labels
+
+
+class FakeRow(object):
+
+    """ Just enough of a MetricValue to render it """
+
+    def __init__(self, name, labels, value):
+        self.name = name
+        self.labels = labels
+        self.value = value
+
+
+def _rows(metrics):
+    """ Get the rows that a Metrics would flush """
+    return [FakeRow(name, labels, value) for (name, labels), value in
+            metrics._pending.iteritems()]
+
+
+class TestSplitLabels(TestCase):
+
+    """ Tests for _split_labels """
+
+    def test_empty(self):
+        """ No labels split into nothing """
+        self.assertEqual(_split_labels(''), [])
+
+    def test_split(self):
+        """ Labels are split on commas """
+        self.assertEqual(_split_labels('a="1",b="2"'), ['a="1"', 'b="2"'])
+
+    def test_quoted_comma(self):
+        """ Commas in label values don't split """
+        self.assertEqual(_split_labels('a="x,y",b="z"'), ['a="x,y"', 'b="z"'])
+
+    def test_escaped_quote(self):
+        """ Escaped quotes don't end a label value """
+        self.assertEqual(_split_labels(r'a="x\",y",b="z"'),
+                         [r'a="x\",y"', 'b="z"'])
+
+    def test_escaped_backslash(self):
+        """ An escaped backslash doesn't escape the closing quote """
+        self.assertEqual(_split_labels(r'a="x\\",b="z"'),
+                         [r'a="x\\"', 'b="z"'])
+
+
+class TestRender(TestCase):
+
+    """ Tests for render """
+
+    def setUp(self):
+        super(TestRender, self).setUp()
+        self.metrics = Metrics()
+
+    def test_counter(self):
+        """ Counters are rendered with their help and type """
+        self.metrics.inc('palantir_alerts_total', action='raised')
+        self.metrics.inc('palantir_alerts_total', 2, action='raised')
+        lines = render(_rows(self.metrics)).splitlines()
+        self.assertEqual(lines, [
+            '# HELP palantir_alerts_total Alerts raised and resolved',
+            '# TYPE palantir_alerts_total counter',
+            'palantir_alerts_total{action="raised"} 3.0',
+        ])
+
+    def test_histogram(self):
+        """ Histogram buckets are rendered cumulatively """
+        for value in (0.05, 3, 200):
+            self.metrics.observe('palantir_handler_seconds', value,
+                                 handler='log')
+        lines = render(_rows(self.metrics)).splitlines()
+        prefix = 'palantir_handler_seconds_bucket{handler="log",'
+        self.assertIn(prefix + 'le="0.01"} 0.0', lines)
+        self.assertIn(prefix + 'le="0.05"} 1.0', lines)
+        self.assertIn(prefix + 'le="2.5"} 1.0', lines)
+        self.assertIn(prefix + 'le="5.0"} 2.0', lines)
+        self.assertIn(prefix + 'le="120.0"} 2.0', lines)
+        self.assertIn(prefix + 'le="+Inf"} 3.0', lines)
+        self.assertIn('palantir_handler_seconds_count{handler="log"} 3.0',
+                      lines)
+        total = [line for line in lines if
+                 line.startswith('palantir_handler_seconds_sum')]
+        self.assertEqual(len(total), 1)
+        self.assertAlmostEqual(float(total[0].split()[1]), 203.05)
+
+    def test_histogram_label_commas(self):
+        """ Histogram labels may contain commas """
+        self.metrics.observe('palantir_handler_seconds', 0.05,
+                             handler='a,b')
+        lines = render(_rows(self.metrics)).splitlines()
+        self.assertIn('palantir_handler_seconds_bucket{handler="a,b",'
+                      'le="0.05"} 1.0', lines)
+
+    def test_unknown(self):
+        """ Rows for unknown metrics are not rendered """
+        self.assertEqual(render([FakeRow('other', '', 1)]), '\n')
+
+    def test_gauges(self):
+        """ Gauges are rendered after the stored metrics """
+        text = render([], {'palantir_alert_queue_depth': ('Queued', 4)})
+        self.assertEqual(text.splitlines(), [
+            '# HELP palantir_alert_queue_depth Queued',
+            '# TYPE palantir_alert_queue_depth gauge',
+            'palantir_alert_queue_depth 4.0',
+        ])
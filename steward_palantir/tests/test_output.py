@@ -0,0 +1,85 @@
+""" Tests for bounding and compressing check output """
+from unittest import TestCase
+
+from steward_palantir.output import (truncate_output, compress_output,
+                                     decompress_output, COMPRESSED_PREFIX,
+                                     COMPRESS_THRESHOLD, TRUNCATION_MARKER)
+
+
+class TestTruncateOutput(TestCase):
+
+    """ Tests for truncate_output """
+
+    def test_short(self):
+        """ Output under the limit is unchanged """
+        self.assertEqual(truncate_output(u'abc', 3), u'abc')
+
+    def test_unlimited(self):
+        """ A limit of 0 keeps all of the output """
+        self.assertEqual(truncate_output(u'a' * 100, 0), u'a' * 100)
+
+    def test_none(self):
+        """ Missing output stays missing """
+        self.assertIsNone(truncate_output(None, 10))
+
+    def test_head_and_tail(self):
+        """ Long output keeps its head and tail around a marker """
+        text = u'abcdefghij'
+        self.assertEqual(truncate_output(text, 4),
+                         u'ab' + TRUNCATION_MARKER % 6 + u'ij')
+
+    def test_odd_limit(self):
+        """ An odd limit keeps the extra character in the tail """
+        self.assertEqual(truncate_output(u'abcdefghij', 3),
+                         u'a' + TRUNCATION_MARKER % 7 + u'ij')
+
+    def test_limit_one(self):
+        """ A limit of 1 keeps only the last character """
+        self.assertEqual(truncate_output(u'abc', 1),
+                         TRUNCATION_MARKER % 2 + u'c')
+
+    def test_decode_bytes(self):
+        """ Byte strings are decoded as UTF-8 """
+        text = truncate_output(u'\u2603'.encode('utf-8') + 'a', 10)
+        self.assertEqual(text, u'\u2603a')
+        self.assertIsInstance(text, unicode)
+
+
+class TestCompressOutput(TestCase):
+
+    """ Tests for compress_output and decompress_output """
+
+    def test_short(self):
+        """ Short output is stored as-is """
+        self.assertEqual(compress_output(u'abc'), u'abc')
+        self.assertEqual(decompress_output(u'abc'), u'abc')
+
+    def test_none(self):
+        """ Missing output stays missing """
+        self.assertIsNone(compress_output(None))
+        self.assertIsNone(decompress_output(None))
+
+    def test_long(self):
+        """ Long output is compressed and can be decompressed """
+        text = u'\u2603' * (COMPRESS_THRESHOLD + 1)
+        stored = compress_output(text)
+        self.assertTrue(stored.startswith(COMPRESSED_PREFIX))
+        self.assertLess(len(stored), len(text))
+        self.assertEqual(decompress_output(stored), text)
+
+    def test_threshold(self):
+        """ Output exactly at the threshold is not compressed """
+        text = u'a' * COMPRESS_THRESHOLD
+        self.assertEqual(compress_output(text), text)
+
+    def test_looks_compressed(self):
+        """ Short output that starts with the prefix is still round-tripped """
+        text = COMPRESSED_PREFIX + u'not really'
+        stored = compress_output(text)
+        self.assertNotEqual(stored, text)
+        self.assertEqual(decompress_output(stored), text)
+
+    def test_decode_bytes(self):
+        """ Byte strings are decoded as UTF-8 """
+        self.assertEqual(compress_output(u'\u2603'.encode('utf-8')),
+                         u'\u2603')
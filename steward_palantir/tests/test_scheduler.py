@@ -0,0 +1,186 @@
+""" Tests for scheduling checks """
+from unittest import TestCase
+
+from steward_palantir.scheduler import (is_due, due_checks, late_checks,
+                                        adapt_interval, check_phase,
+                                        window_start, AdaptiveSchedule)
+
+
+class FakeCheck(object):
+
+    """ Just enough of a check to schedule it """
+
+    def __init__(self, **schedule):
+        self.schedule = schedule
+
+
+class FakeSchedule(object):
+
+    """ Just enough of a CheckSchedule for due_checks """
+
+    def __init__(self, interval, next_run):
+        self.interval = interval
+        self.next_run = next_run
+
+
+class TestIsDue(TestCase):
+
+    """ Tests for is_due """
+
+    def setUp(self):
+        super(TestIsDue, self).setUp()
+        self.interval = 60
+        # The time of one of the runs of the check
+        self.run = 600000 * self.interval + check_phase('check',
+                                                        self.interval)
+
+    def test_end_inclusive(self):
+        """ A run at the end of the window is due """
+        self.assertTrue(is_due('check', self.interval, self.run - 5,
+                               self.run))
+
+    def test_start_exclusive(self):
+        """ A run at the start of the window is not due """
+        self.assertFalse(is_due('check', self.interval, self.run,
+                                self.run + 5))
+
+    def test_not_due(self):
+        """ A window between runs has nothing due """
+        self.assertFalse(is_due('check', self.interval, self.run + 5,
+                                self.run + 10))
+
+    def test_multiple_runs(self):
+        """ A window that covers several runs is due once """
+        self.assertTrue(is_due('check', self.interval, self.run - 1,
+                               self.run + 10 * self.interval))
+
+    def test_no_interval(self):
+        """ Checks with no interval are never due """
+        self.assertFalse(is_due('check', 0, self.run - 5, self.run + 5))
+
+    def test_consecutive_windows(self):
+        """ Consecutive windows run a check exactly once per interval """
+        start = self.run - 1000
+        runs = sum(is_due('check', self.interval, t, t + 5) for t in
+                   xrange(int(start), int(start) + 50 * self.interval, 5))
+        self.assertEqual(runs, 50)
+
+    def test_phase_spread(self):
+        """ Checks with the same interval run at different offsets """
+        phases = set(check_phase('check%d' % i, 60) for i in xrange(20))
+        self.assertEqual(len(phases), 20)
+        for phase in phases:
+            self.assertTrue(0 <= phase < 60)
+
+
+class TestDueChecks(TestCase):
+
+    """ Tests for due_checks """
+
+    def setUp(self):
+        super(TestDueChecks, self).setUp()
+        self.checks = {
+            'minutely': FakeCheck(minutes=1),
+            'daily': FakeCheck(days=1),
+        }
+        self.run = 100000 * 60 + check_phase('minutely', 60)
+
+    def test_fixed(self):
+        """ Fixed interval checks are due when is_due says so """
+        due = due_checks(self.checks, self.run - 5, self.run)
+        self.assertIn('minutely', due)
+        due = due_checks(self.checks, self.run, self.run + 5)
+        self.assertNotIn('minutely', due)
+
+    def test_adaptive_due(self):
+        """ An adaptive check is due when next_run is in the window """
+        schedule = FakeSchedule(30, 1000)
+        due = due_checks(self.checks, 995, 1000, {'minutely': schedule})
+        self.assertIn('minutely', due)
+        self.assertEqual(schedule.next_run, 1030)
+
+    def test_adaptive_start_exclusive(self):
+        """ An adaptive check is not due when next_run is the window start """
+        schedule = FakeSchedule(30, 995)
+        due = due_checks(self.checks, 995, 1000, {'minutely': schedule})
+        self.assertNotIn('minutely', due)
+
+    def test_adaptive_not_due(self):
+        """ An adaptive check is not due before next_run """
+        schedule = FakeSchedule(30, 1001)
+        due = due_checks(self.checks, 995, 1000, {'minutely': schedule})
+        self.assertNotIn('minutely', due)
+        self.assertEqual(schedule.next_run, 1001)
+
+    def test_adaptive_too_late(self):
+        """ An adaptive check that missed the window is rescheduled """
+        schedule = FakeSchedule(30, 900)
+        due = due_checks(self.checks, 995, 1000, {'minutely': schedule})
+        self.assertNotIn('minutely', due)
+        self.assertTrue(1000 <= schedule.next_run < 1030)
+
+
+class TestCatchUp(TestCase):
+
+    """ Tests for catching up on missed runs """
+
+    def test_window_start(self):
+        """ The window reaches back to the last tick """
+        self.assertEqual(window_start(900, 1000, {}), 900)
+
+    def test_window_start_max(self):
+        """ The window reaches back at most palantir.max_catchup seconds """
+        settings = {'palantir.max_catchup': '60'}
+        self.assertEqual(window_start(900, 1000, settings), 940)
+
+    def test_late(self):
+        """ Checks that only ran because of a late tick are late """
+        checks = {'minutely': FakeCheck(minutes=1)}
+        run = 100000 * 60 + check_phase('minutely', 60)
+        self.assertEqual(late_checks(checks, run - 5, run + 10, run + 15),
+                         ['minutely'])
+        self.assertEqual(late_checks(checks, run - 5, run - 1, run + 15), [])
+
+    def test_on_time(self):
+        """ Nothing is late if the tick was on time """
+        checks = {'minutely': FakeCheck(minutes=1)}
+        run = 100000 * 60 + check_phase('minutely', 60)
+        self.assertEqual(late_checks(checks, run - 5, run - 10, run), [])
+
+    def test_late_adaptive(self):
+        """ Adaptive checks are late if next_run was before the tick """
+        checks = {'minutely': FakeCheck(minutes=1)}
+        schedule = FakeSchedule(30, 990)
+        self.assertEqual(late_checks(checks, 980, 995, 1000,
+                                     {'minutely': schedule}), ['minutely'])
+        self.assertEqual(late_checks(checks, 980, 985, 1000,
+                                     {'minutely': schedule}), [])
+
+
+class TestAdaptInterval(TestCase):
+
+    """ Tests for adapt_interval """
+
+    def setUp(self):
+        super(TestAdaptInterval, self).setUp()
+        self.adaptive = AdaptiveSchedule(10, 80, 3)
+
+    def test_failing(self):
+        """ A failing check halves its interval """
+        self.assertEqual(adapt_interval(self.adaptive, 40, 2, True), (20, 0))
+
+    def test_failing_min(self):
+        """ The interval doesn't go below the minimum """
+        self.assertEqual(adapt_interval(self.adaptive, 15, 0, True), (10, 0))
+
+    def test_stable(self):
+        """ A check that passes enough times doubles its interval """
+        self.assertEqual(adapt_interval(self.adaptive, 20, 1, False),
+                         (20, 2))
+        self.assertEqual(adapt_interval(self.adaptive, 20, 2, False),
+                         (40, 0))
+
+    def test_stable_max(self):
+        """ The interval doesn't go above the maximum """
+        self.assertEqual(adapt_interval(self.adaptive, 60, 2, False),
+                         (80, 0))
@@ -0,0 +1,92 @@
+""" Tests for the palantir endpoints """
+import base64
+import json
+from datetime import datetime
+from unittest import TestCase
+
+from pyramid.httpexceptions import HTTPBadRequest
+
+from steward_palantir.models import Alert
+from steward_palantir.views import (ALERT_ORDERINGS, _encode_cursor,
+                                    _cursor_filter)
+
+
+def _cursor(values):
+    """ Encode arbitrary values as a cursor """
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+class TestAlertCursor(TestCase):
+
+    """ Tests for the alert pagination cursors """
+
+    def setUp(self):
+        super(TestAlertCursor, self).setUp()
+        self.alert = Alert('minion1', 'check1', '', '', 2)
+        self.alert.id = 7
+        self.alert.created = datetime(2014, 1, 2, 3, 4, 5, 6)
+
+    def test_round_trip(self):
+        """ The filter compares against the values of the alert """
+        ordering = ALERT_ORDERINGS['minion']
+        clause = _cursor_filter(ordering,
+                                _encode_cursor(ordering, self.alert))
+        self.assertEqual(sorted(clause.compile().params.values()),
+                         ['check1', 'minion1', 'minion1'])
+
+    def test_tie_breaker(self):
+        """ Each column is compared once the previous ones are equal """
+        ordering = ALERT_ORDERINGS['check'] + ((Alert.id, False),)
+        clause = _cursor_filter(ordering,
+                                _encode_cursor(ordering, self.alert))
+        params = clause.compile().params.values()
+        self.assertEqual(params.count('check1'), 3)
+        self.assertEqual(params.count('minion1'), 2)
+        self.assertEqual(params.count(7), 1)
+
+    def test_created(self):
+        """ Timestamps are encoded with microseconds """
+        ordering = ALERT_ORDERINGS['-created']
+        clause = _cursor_filter(ordering,
+                                _encode_cursor(ordering, self.alert))
+        self.assertEqual(clause.compile().params.values(),
+                         [self.alert.created])
+        self.assertIn('<', str(clause))
+
+    def test_ascending(self):
+        """ Ascending columns continue with larger values """
+        ordering = ALERT_ORDERINGS['created']
+        clause = _cursor_filter(ordering,
+                                _encode_cursor(ordering, self.alert))
+        self.assertIn('>', str(clause))
+
+    def test_not_base64(self):
+        """ A cursor that isn't base64 is rejected """
+        with self.assertRaises(HTTPBadRequest):
+            _cursor_filter(ALERT_ORDERINGS['minion'], 'abc')
+
+    def test_not_json(self):
+        """ A cursor that isn't JSON is rejected """
+        cursor = base64.urlsafe_b64encode('not json')
+        with self.assertRaises(HTTPBadRequest):
+            _cursor_filter(ALERT_ORDERINGS['minion'], cursor)
+
+    def test_not_list(self):
+        """ A cursor that isn't a list is rejected """
+        with self.assertRaises(HTTPBadRequest):
+            _cursor_filter(ALERT_ORDERINGS['minion'], _cursor({'a': 1}))
+
+    def test_wrong_length(self):
+        """ A cursor for a different ordering is rejected """
+        with self.assertRaises(HTTPBadRequest):
+            _cursor_filter(ALERT_ORDERINGS['minion'], _cursor(['minion1']))
+
+    def test_bad_timestamp(self):
+        """ A cursor with a malformed timestamp is rejected """
+        with self.assertRaises(HTTPBadRequest):
+            _cursor_filter(ALERT_ORDERINGS['created'], _cursor(['today']))
+
+    def test_timestamp_not_string(self):
+        """ A cursor with a non-string timestamp is rejected """
+        with self.assertRaises(HTTPBadRequest):
+            _cursor_filter(ALERT_ORDERINGS['created'], _cursor([5]))
@@ -1,21 +1,106 @@
 """ Endpoints for Palantir """
+import base64
+import itertools
+import json
 import logging
 from collections import defaultdict
+from datetime import datetime
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound
 from pyramid.security import unauthenticated_userid
 from pyramid.view import view_config
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import defer, Session
 
-from .models import CheckDisabled, MinionDisabled, CheckResult, Alert
+from .alerting import async_alerts, alert_queue, alert_queue_depth
+from .metrics import render
+from .models import (CheckDisabled, MinionDisabled, CheckResult, CheckHistory,
+                     Alert, MetricValue, CheckProfile)
 from .tasks import toggle_minion, resolve_alerts, run_check, prune
 from pyramid_duh import argify
+from steward_tasks import celery
 
 
 LOG = logging.getLogger(__name__)
 
+# Fields that may be requested with the 'fields' parameter
+RESULT_FIELDS = {
+    Alert: ('minion', 'check', 'stdout', 'stderr', 'retcode', 'created'),
+    CheckResult: ('minion', 'check', 'stdout', 'stderr', 'retcode',
+                  'last_run', 'count', 'alert', 'enabled'),
+}
+# Fields that are stored in large columns
+OUTPUT_FIELDS = ('stdout', 'stderr')
+
+
+def _parse_fields(model, fields):
+    """
+    Parse and validate the 'fields' parameter for a model
+
+    Parameters
+    ----------
+    model : type
+        :class:`~steward_palantir.models.Alert` or
+        :class:`~steward_palantir.models.CheckResult`
+    fields : str or None
+        Comma-separated list of fields
+
+    Returns
+    -------
+    fields : list or None
+        None if all fields were requested
+
+    """
+    if fields is None:
+        return None
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = set(fields) - set(RESULT_FIELDS[model])
+    if unknown:
+        raise HTTPBadRequest("Unknown field(s) '%s'" %
+                             "', '".join(sorted(unknown)))
+    return fields
+
+
+def _defer_output(query, model, fields):
+    """ Don't load the output columns unless they were requested """
+    if fields is None:
+        return query
+    for field in OUTPUT_FIELDS:
+        if field not in fields:
+            query = query.options(defer(getattr(model, '_' + field)))
+    return query
+
+
+def _project(results, fields):
+    """
+    Serialize only the requested fields of some results
+
+    Parameters
+    ----------
+    results : list
+        List of :class:`~steward_palantir.models.Alert` or
+        :class:`~steward_palantir.models.CheckResult`
+    fields : list or None
+        None to return the results unchanged
+
+    """
+    if fields is None:
+        return results
+    projected = []
+    for result in results:
+        data = {}
+        for field in fields:
+            value = getattr(result, field)
+            if isinstance(value, datetime):
+                value = float(value.strftime('%s.%f'))
+            data[field] = value
+        projected.append(data)
+    return projected
+
 
 @view_config(route_name='palantir_run_check', renderer='json',
              permission='palantir_write')
-@argify
-def do_run_check(request, name):
+@argify(profile=bool)
+def do_run_check(request, name, profile=False):
     """
     Run a check
 
@@ -23,21 +108,67 @@ def do_run_check(request, name):
     ----------
     name : str
         The name of the check to run
+    profile : bool, optional
+        Profile the run (default False)
+
+    """
+    return run_check(name, profile)
+
 
+@view_config(route_name='palantir_list_check_profiles', renderer='json',
+             permission='palantir_read')
+@argify(limit=int)
+def list_check_profiles(request, check, limit=20):
     """
-    return run_check(name)
+    List the stored profiles of a check, newest first
+
+    Parameters
+    ----------
+    check : str
+    limit : int, optional
+        Maximum number of profiles to return (default 20)
+
+    """
+    return request.db.query(CheckProfile).filter_by(check=check)\
+        .options(defer(CheckProfile.data))\
+        .order_by(CheckProfile.id.desc()).limit(limit).all()
+
+
+@view_config(route_name='palantir_get_check_profile',
+             permission='palantir_read')
+@argify(id=int)
+def get_check_profile(request, id):  # pylint: disable=W0622
+    """
+    Download a stored profile in the pstats format
+
+    Parameters
+    ----------
+    id : int
+        The id of the profile
+
+    """
+    profile = request.db.query(CheckProfile).filter_by(id=id).first()
+    if profile is None:
+        raise HTTPNotFound()
+    response = request.response
+    response.content_type = 'application/octet-stream'
+    response.content_disposition = 'attachment; filename="%s-%d.prof"' % \
+        (profile.check, profile.id)
+    response.body = profile.data
+    return response
 
 
 @view_config(route_name='palantir_list_checks', renderer='json',
              permission='palantir_read')
 def list_checks(request):
     """ List all available checks """
+    request.registry.palantir_check_loader.reload(request.registry)
     checks = request.registry.palantir_checks
+    disabled = request.registry.palantir_disabled.get(request.db)
     json_checks = {}
     for name, check in checks.iteritems():
         data = check.__json__(request)
-        data['enabled'] = not bool(request.db.query(CheckDisabled)
-                                   .filter_by(name=name).first())
+        data['enabled'] = name not in disabled.checks
         json_checks[name] = data
     return json_checks
 
@@ -45,13 +176,26 @@ def list_checks(request):
 @view_config(route_name='palantir_get_check', renderer='json',
              permission='palantir_read')
 @argify
-def get_check(request, check):
-    """ Get detailed data about a check """
+def get_check(request, check, fields=None):
+    """
+    Get detailed data about a check
+
+    Parameters
+    ----------
+    check : str
+    fields : str, optional
+        Comma-separated list of the fields of the results to return (default
+        all)
+
+    """
+    fields = _parse_fields(CheckResult, fields)
     checks = request.registry.palantir_checks
+    disabled = request.registry.palantir_disabled.get(request.db)
     data = checks[check].__json__(request)
-    data['enabled'] = not bool(request.db.query(CheckDisabled)
-                               .filter_by(name=check).first())
-    data['results'] = request.db.query(CheckResult).filter_by(check=check).all()
+    data['enabled'] = check not in disabled.checks
+    query = request.db.query(CheckResult).filter_by(check=check)
+    data['results'] = _project(_defer_output(query, CheckResult, fields).all(),
+                               fields)
 
     return data
 
@@ -65,6 +209,33 @@ def get_minion_check(request, minion, check):
                                                    check=check).one()
 
 
+@view_config(route_name='palantir_get_minion_check_history', renderer='json',
+             permission='palantir_read')
+@argify(limit=int)
+def get_minion_check_history(request, minion, check, limit=100):
+    """
+    Get the history of a check on a minion
+
+    Parameters
+    ----------
+    minion : str
+    check : str
+    limit : int, optional
+        Maximum number of entries to return (default 100)
+
+    Returns
+    -------
+    history : list
+        List of :class:`~steward_palantir.models.CheckHistory` entries, most
+        recent first
+
+    """
+    return request.db.query(CheckHistory)\
+        .filter_by(check=check, minion=minion)\
+        .order_by(CheckHistory.id.desc())\
+        .limit(limit).all()
+
+
 @view_config(route_name='palantir_toggle_check', permission='palantir_write')
 @argify(checks=list, enabled=bool)
 def toggle_check(request, checks, enabled):
@@ -74,14 +245,169 @@ def toggle_check(request, checks, enabled):
             request.db.query(CheckDisabled).filter_by(name=check).delete()
         else:
             request.db.merge(CheckDisabled(check))
+    request.registry.palantir_disabled.invalidate(request.db)
     return request.response
 
 
+# Columns to sort alerts by, as (column, descending)
+ALERT_ORDERINGS = {
+    'minion': ((Alert.minion, False), (Alert.check, False)),
+    'check': ((Alert.check, False), (Alert.minion, False)),
+    'created': ((Alert.created, False),),
+    '-created': ((Alert.created, True),),
+    'retcode': ((Alert.retcode, True), (Alert.minion, False),
+                (Alert.check, False)),
+}
+CURSOR_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+# Number of check results to fetch and write at a time in an export
+EXPORT_BATCH_SIZE = 1000
+
+
+def _glob_to_like(glob):
+    """ Convert a shell-style glob into a SQL LIKE pattern """
+    pattern = glob.replace('\\', '\\\\').replace('%', '\\%')\
+        .replace('_', '\\_')
+    return pattern.replace('*', '%').replace('?', '_')
+
+
+def _encode_cursor(ordering, alert):
+    """ Create a pagination cursor that points after an alert """
+    values = []
+    for column, _ in ordering:
+        value = getattr(alert, column.key)
+        if isinstance(value, datetime):
+            value = value.strftime(CURSOR_TIME_FORMAT)
+        values.append(value)
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+def _cursor_filter(ordering, cursor):
+    """
+    Create the SQL filter for the rows that come after a cursor
+
+    Raises
+    ------
+    exc : :exc:`pyramid.httpexceptions.HTTPBadRequest`
+        If the cursor is malformed
+
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        if not isinstance(values, list) or len(values) != len(ordering):
+            raise ValueError("Wrong number of values")
+        values = [datetime.strptime(value, CURSOR_TIME_FORMAT)
+                  if column is Alert.created else value
+                  for (column, _), value in zip(ordering, values)]
+    except (TypeError, ValueError, UnicodeError):
+        raise HTTPBadRequest("Invalid cursor")
+    clauses = []
+    for i, (column, descending) in enumerate(ordering):
+        value = values[i]
+        conditions = [prev_column == prev_value for (prev_column, _),
+                      prev_value in zip(ordering[:i], values[:i])]
+        conditions.append(column < value if descending else column > value)
+        clauses.append(and_(*conditions))
+    return or_(*clauses)
+
+
 @view_config(route_name='palantir_list_alerts', renderer='json',
              permission='palantir_read')
-def list_alerts(request):
-    """ List all current alerts """
-    return request.db.query(Alert).all()
+@argify(level=int, since=float, limit=int)
+def list_alerts(request, check=None, minion=None, level=None, since=None,
+                order='minion', limit=None, cursor=None, fields=None):
+    """
+    List current alerts
+
+    Parameters
+    ----------
+    check : str, optional
+        Only list alerts for this check
+    minion : str, optional
+        Only list alerts for minions that match this glob
+    level : int, optional
+        Only list warnings (1) or errors (2)
+    since : float, optional
+        Only list alerts created after this unix timestamp
+    order : str, optional
+        One of 'minion', 'check', 'created', '-created', or 'retcode' (default
+        'minion')
+    limit : int, optional
+        Return at most this many alerts. If there are more, the
+        ``X-Palantir-Cursor`` response header will contain the cursor for the
+        next page.
+    cursor : str, optional
+        Cursor from a previous call with the same filters and order
+    fields : str, optional
+        Comma-separated list of the fields to return (default all)
+
+    """
+    if order not in ALERT_ORDERINGS:
+        raise HTTPBadRequest("Unknown order '%s'" % order)
+    if limit is not None and limit < 1:
+        raise HTTPBadRequest("limit must be at least 1")
+    if level not in (None, 1, 2):
+        raise HTTPBadRequest("level must be 1 or 2")
+    ordering = ALERT_ORDERINGS[order] + ((Alert.id, False),)
+    fields = _parse_fields(Alert, fields)
+
+    query = _defer_output(request.db.query(Alert), Alert, fields)
+    if check is not None:
+        query = query.filter(Alert.check == check)
+    if minion is not None:
+        if '*' in minion or '?' in minion:
+            query = query.filter(Alert.minion.like(_glob_to_like(minion),
+                                                   escape='\\'))
+        else:
+            query = query.filter(Alert.minion == minion)
+    if level == 1:
+        query = query.filter(Alert.retcode == 1)
+    elif level == 2:
+        query = query.filter(Alert.retcode.notin_((0, 1)))
+    if since is not None:
+        query = query.filter(Alert.created > datetime.fromtimestamp(since))
+    if cursor is not None:
+        query = query.filter(_cursor_filter(ordering, cursor))
+
+    query = query.order_by(*[column.desc() if descending else column for
+                             column, descending in ordering])
+    if limit is None:
+        return _project(query.all(), fields)
+
+    alerts = query.limit(limit + 1).all()
+    if len(alerts) > limit:
+        alerts = alerts[:limit]
+        request.response.headers['X-Palantir-Cursor'] = \
+            _encode_cursor(ordering, alerts[-1])
+    return _project(alerts, fields)
+
+
+@view_config(route_name='palantir_alert_queue', renderer='json',
+             permission='palantir_read')
+def get_alert_queue(request):
+    """ Get the number of alert deliveries waiting in the alert queue """
+    settings = request.registry.settings
+    return {
+        'queue': alert_queue(settings),
+        'async': async_alerts(settings),
+        'depth': alert_queue_depth(celery, settings),
+    }
+
+
+@view_config(route_name='palantir_metrics', permission='palantir_read')
+def get_metrics(request):
+    """ Get the metrics of all workers in the Prometheus text format """
+    settings = request.registry.settings
+    gauges = {}
+    if async_alerts(settings):
+        depth = alert_queue_depth(celery, settings)
+        if depth is not None:
+            gauges['palantir_alert_queue_depth'] = (
+                "Alert deliveries waiting in the alert queue", depth)
+    response = request.response
+    response.content_type = 'text/plain'
+    response.charset = 'utf-8'
+    response.text = render(request.db.query(MetricValue).all(), gauges)
+    return response
 
 
 @view_config(route_name='palantir_get_alert', renderer='json',
@@ -114,12 +440,12 @@ def list_handlers(request):
 def list_minions(request):
     """ List all salt minions """
     keys = request.subreq('salt_key', cmd='list_keys')
+    disabled = request.registry.palantir_disabled.get(request.db)
     minions = {}
     for name in keys['minions']:
         minions[name] = {
             'name': name,
-            'enabled': not bool(request.db.query(MinionDisabled)
-                                .filter_by(name=name).first()),
+            'enabled': name not in disabled.minions,
         }
     return minions
 
@@ -129,21 +455,35 @@ def list_minions(request):
 def delete_minion(request, minion):
     """ Delete a minion and its data """
     request.db.query(MinionDisabled).filter_by(name=minion).delete()
+    request.registry.palantir_disabled.invalidate(request.db)
     request.db.query(CheckResult).filter_by(minion=minion).delete()
     request.db.query(Alert).filter_by(minion=minion).delete()
+    request.db.query(CheckHistory).filter_by(minion=minion).delete()
     return request.response
 
 
 @view_config(route_name='palantir_get_minion', renderer='json',
              permission='palantir_read')
 @argify
-def get_minion(request, minion):
-    """ Get some data about a minion """
+def get_minion(request, minion, fields=None):
+    """
+    Get some data about a minion
+
+    Parameters
+    ----------
+    minion : str
+    fields : str, optional
+        Comma-separated list of the fields of the check results to return
+        (default all)
+
+    """
+    fields = _parse_fields(CheckResult, fields)
     data = {'name': minion}
-    results = request.db.query(CheckResult).filter_by(minion=minion).all()
-    data['checks'] = results
-    data['enabled'] = not bool(request.db.query(MinionDisabled)
-                               .filter_by(name=minion).first())
+    query = request.db.query(CheckResult).filter_by(minion=minion)
+    data['checks'] = _project(_defer_output(query, CheckResult, fields).all(),
+                              fields)
+    data['enabled'] = not request.registry.palantir_disabled\
+        .minion_disabled(request.db, minion)
     return data
 
 
@@ -160,25 +500,86 @@ def do_toggle_minion(request, minions, enabled):
 @argify(checks=list, enabled=bool)
 def toggle_minion_check(request, minion, checks, enabled):
     """ Enable/disable a check on a specific minion """
-    for check in checks:
-        result = request.db.query(CheckResult).filter_by(check=check,
-                                                         minion=minion).first()
-        if result is None:
-            result = CheckResult(minion, check)
-            request.db.add(result)
-        result.enabled = enabled
+    query = request.db.query(CheckResult).filter_by(minion=minion)\
+        .filter(CheckResult.check.in_(checks))
+    existing = set(itertools.chain.from_iterable(
+        query.with_entities(CheckResult.check).all()))
+    query.update({CheckResult.enabled: enabled}, synchronize_session=False)
+    CheckResult.bulk_create(request.db, [(minion, check) for check in checks
+                                         if check not in existing],
+                            enabled=enabled)
     return request.response
 
 
 @view_config(route_name='palantir_list_minion_checks', renderer='json',
              permission='palantir_read')
-def list_minion_checks(request):
-    """ List all salt minions and their associated checks """
+@argify
+def list_minion_checks(request, fields=None):
+    """
+    List all salt minions and their associated checks
+
+    Parameters
+    ----------
+    fields : str, optional
+        Comma-separated list of the fields of the check results to return
+        (default all)
+
+    """
+    fields = _parse_fields(CheckResult, fields)
     minions = defaultdict(list)
-    results = request.db.query(CheckResult).all()
-    for result in results:
+    query = _defer_output(request.db.query(CheckResult), CheckResult, fields)
+    for result in query:
         minions[result.minion].append(result)
-    return dict(minions)
+    return dict((minion, _project(results, fields))
+                for minion, results in minions.iteritems())
+
+
+@view_config(route_name='palantir_export_minion_checks',
+             permission='palantir_read')
+@argify
+def export_minion_checks(request, check=None, minion=None):
+    """
+    Stream all check results as newline-delimited JSON
+
+    Parameters
+    ----------
+    check : str, optional
+        Only export the results of this check
+    minion : str, optional
+        Only export the results for this minion
+
+    """
+    engine = request.db.get_bind()
+
+    def generate():
+        """ Generator for chunks of the response body """
+        # The body is written after the request's transaction has finished,
+        # so this needs a session of its own
+        db = Session(bind=engine)
+        try:
+            query = db.query(CheckResult)
+            if check is not None:
+                query = query.filter_by(check=check)
+            if minion is not None:
+                query = query.filter_by(minion=minion)
+            query = query.order_by(CheckResult.id)\
+                .execution_options(stream_results=True)\
+                .yield_per(EXPORT_BATCH_SIZE)
+            lines = []
+            for result in query:
+                lines.append(json.dumps(result.__json__(request)))
+                if len(lines) >= EXPORT_BATCH_SIZE:
+                    yield '\n'.join(lines) + '\n'
+                    lines = []
+            if lines:
+                yield '\n'.join(lines) + '\n'
+        finally:
+            db.close()
+
+    response = request.response
+    response.content_type = 'application/x-ndjson'
+    response.app_iter = generate()
+    return response
 
 
 @view_config(route_name='palantir_prune', renderer='json',